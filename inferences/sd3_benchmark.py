@@ -0,0 +1,278 @@
+import argparse
+import math
+import time
+from typing import Callable, Dict
+
+import torch
+import logging
+from networks.stable_diffusion3 import sd3_models
+from networks.stable_diffusion3.sd3_utils import setup_logging
+
+setup_logging()
+
+logger = logging.getLogger(__name__)
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def measure(
+    fn: Callable[[], object], device: torch.device, warmup: int, repeat: int
+) -> Dict[str, float]:
+    """
+    Returns seconds per call, MiB allocated by one call and peak MiB of the tensors alive at the same time during
+    the call, counted by sd3_models.MemoryCounter on any device.
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+
+        counter = sd3_models.MemoryCounter()
+        with counter:
+            fn()
+
+        synchronize(device)
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        synchronize(device)
+        elapsed = (time.perf_counter() - start_time) / repeat
+
+    return {
+        "seconds": elapsed,
+        "allocated_mib": counter.allocated_bytes / 2**20,
+        "peak_mib": counter.peak_bytes / 2**20,
+    }
+
+
+def log_result(name: str, result: Dict[str, float]):
+    logger.info(
+        f"{name}: {result['seconds'] * 1000:.2f} ms, allocated {result['allocated_mib']:.1f} MiB,"
+        f" peak {result['peak_mib']:.1f} MiB"
+    )
+
+
+def legacy_modulate(x, shift, scale, inplace=False):
+    # modulate before it was made allocation-free, for comparison
+    if shift is None:
+        shift = torch.zeros_like(scale)
+    return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+
+
+def create_random_mmdit(args: argparse.Namespace, device, dtype) -> sd3_models.MMDiT:
+    mmdit = sd3_models.MMDiT(
+        input_size=None,
+        pos_embed_max_size=192,
+        patch_size=2,
+        in_channels=16,
+        adm_in_channels=2048,
+        depth=args.depth,
+        mlp_ratio=4,
+        qk_norm=None,
+        num_patches=36864,
+        context_size=4096,
+        attn_mode=args.attn_mode,
+        scale_mod_only=args.scale_mod_only,
+    )
+    for tensor in mmdit.state_dict().values():
+        tensor.normal_(0, 0.02)
+    return mmdit.to(device, dtype).eval()
+
+
+def benchmark_modulate(args: argparse.Namespace, device: torch.device, dtype):
+    hidden_size = 64 * args.depth
+    num_tokens = (args.height // 16) * (args.width // 16)
+    x = torch.randn(
+        args.batch_size, num_tokens, hidden_size, device=device, dtype=dtype
+    )
+    shift = torch.randn(args.batch_size, hidden_size, device=device, dtype=dtype)
+    scale = torch.randn(args.batch_size, hidden_size, device=device, dtype=dtype)
+
+    for shift_name, s in [("shift and scale", shift), ("scale only", None)]:
+        # the input of modulate is a temporary (norm output) in the model, clone it for the in-place variant
+        variants = {
+            "legacy": lambda: legacy_modulate(x, s, scale),
+            "modulate": lambda: sd3_models.modulate(x, s, scale),
+            "modulate in-place": lambda: sd3_models.modulate(
+                x.clone(), s, scale, inplace=True
+            ),
+            "clone only": lambda: x.clone(),
+        }
+        for name, fn in variants.items():
+            log_result(
+                f"{shift_name}, {name}",
+                measure(fn, device, args.warmup, args.repeat),
+            )
+
+
+def benchmark_mmdit(args: argparse.Namespace, device: torch.device, dtype):
+    mmdit = create_random_mmdit(args, device, dtype)
+    x = torch.randn(
+        args.batch_size,
+        16,
+        args.height // 8,
+        args.width // 8,
+        device=device,
+        dtype=dtype,
+    )
+    t = torch.full((args.batch_size,), 500.0, device=device)
+    context = torch.randn(args.batch_size, 154, 4096, device=device, dtype=dtype)
+    y = torch.randn(args.batch_size, 2048, device=device, dtype=dtype)
+
+    def forward():
+        return mmdit(x, t, y=y, context=context)
+
+    modulate = sd3_models.modulate
+    try:
+        sd3_models.modulate = legacy_modulate
+        log_result(
+            "MMDiT forward, legacy modulate",
+            measure(forward, device, args.warmup, args.repeat),
+        )
+    finally:
+        sd3_models.modulate = modulate
+    log_result("MMDiT forward", measure(forward, device, args.warmup, args.repeat))
+
+    # all adaLN modulations in one matmul, see MMDiT.fuse_adaln_modulation
+    with torch.no_grad():
+        expected = forward()
+    try:
+        mmdit.fuse_adaln_modulation()
+        log_result(
+            "MMDiT forward, fused adaLN",
+            measure(forward, device, args.warmup, args.repeat),
+        )
+        with torch.no_grad():
+            max_diff = (forward() - expected).abs().max().item()
+        logger.info(f"MMDiT forward, fused adaLN: max abs diff {max_diff:.2e}")
+    finally:
+        mmdit.unfuse_adaln_modulation()
+
+
+def psnr(images: torch.Tensor, reference: torch.Tensor) -> float:
+    # images are in [-1, 1]
+    mse = torch.mean((images.float() - reference.float()) ** 2).item()
+    return 10 * math.log10(4.0 / mse) if mse > 0 else float("inf")
+
+
+def benchmark_vae_precision(args: argparse.Namespace, device: torch.device, dtype):
+    # weights are in dtype (fp32 unless --fp16/--bf16), the precision policy sets the autocast dtype
+    vae = sd3_models.SDVAE(dtype=dtype, device=device).eval()
+    latent = torch.randn(
+        args.batch_size, 16, args.height // 8, args.width // 8, device=device
+    ).to(dtype)
+    with torch.no_grad():
+        vae.set_precision("fp32")
+        reference = vae.decode(latent)
+
+    for precision, (autocast_dtype, device_types) in sd3_models.VAE_PRECISIONS.items():
+        if autocast_dtype is not None and device.type not in device_types:
+            logger.info(f"VAE decode, {precision}: not used on {device.type}")
+            continue
+        vae.set_precision(precision)
+        log_result(
+            f"VAE decode, {precision}",
+            measure(lambda: vae.decode(latent), device, args.warmup, args.repeat),
+        )
+        with torch.no_grad():
+            images = vae.decode(latent)
+        logger.info(
+            f"VAE decode, {precision}: PSNR vs fp32 {psnr(images, reference):.2f} dB"
+        )
+
+
+def benchmark_vae_decode(args: argparse.Namespace, device: torch.device, dtype):
+    # default VAE and optimize_for_inference with the same weights, at each size in --vae_sizes
+    vae = sd3_models.SDVAE(dtype=dtype, device=device).eval()
+    optimized = sd3_models.SDVAE(dtype=dtype, device=device).eval()
+    optimized.load_state_dict(vae.state_dict())
+    optimized.optimize_for_inference(compile=args.compile)
+    vae.set_precision(args.vae_precision)
+    optimized.set_precision(args.vae_precision)
+
+    for size in args.vae_sizes:
+        latent = torch.randn(
+            args.batch_size, 16, size // 8, size // 8, device=device, dtype=dtype
+        )
+        for name, model in [("default", vae), ("optimized", optimized)]:
+            log_result(
+                f"VAE decode {size}x{size}, {name}",
+                measure(lambda: model.decode(latent), device, args.warmup, args.repeat),
+            )
+
+
+BENCHMARKS = {
+    "modulate": benchmark_modulate,
+    "mmdit": benchmark_mmdit,
+    "vae_precision": benchmark_vae_precision,
+    "vae_decode": benchmark_vae_decode,
+}
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=list(BENCHMARKS.keys()))
+    parser.add_argument(
+        "--device", type=str, default=None, help="default: cuda if available"
+    )
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument(
+        "--depth", type=int, default=24, help="MMDiT depth. default: 24 (SD3 medium)"
+    )
+    parser.add_argument(
+        "--scale_mod_only", action="store_true", help="MMDiT with scale-only adaLN"
+    )
+    parser.add_argument(
+        "--attn_mode",
+        type=str,
+        default="torch",
+        choices=list(sd3_models.ATTENTION_BACKENDS.keys()),
+    )
+    parser.add_argument(
+        "--vae_precision",
+        type=str,
+        default="fp32",
+        choices=list(sd3_models.VAE_PRECISIONS.keys()),
+        help="VAE precision of vae_decode. default: fp32",
+    )
+    parser.add_argument(
+        "--vae_sizes",
+        type=int,
+        nargs="+",
+        default=[512, 1024, 2048],
+        help="image sizes of vae_decode. default: 512 1024 2048",
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="torch.compile the optimized VAE"
+    )
+    parser.add_argument("--batch_size", type=int, default=2, help="default: 2 (CFG)")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    return parser
+
+
+if __name__ == "__main__":
+    # python -m inferences.sd3_benchmark mmdit --bf16 --height 1024 --width 1024
+    # python -m inferences.sd3_benchmark modulate --depth 4 --device cpu
+    # python -m inferences.sd3_benchmark mmdit --depth 4 --height 512 --width 512 --device cpu --repeat 3
+    # python -m inferences.sd3_benchmark vae_decode --batch_size 1 --device cpu --repeat 3
+    # python -m inferences.sd3_benchmark vae_precision --batch_size 1 --height 512 --width 512 --device cpu
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    device = torch.device(
+        args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    dtype = torch.float32
+    if args.fp16:
+        dtype = torch.float16
+    elif args.bf16:
+        dtype = torch.bfloat16
+
+    logger.info(f"Benchmark {args.benchmark} on {device}, {dtype}")
+    BENCHMARKS[args.benchmark](args, device, dtype)
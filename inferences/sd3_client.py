@@ -0,0 +1,77 @@
+import argparse
+import base64
+import json
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict
+
+
+def generate(
+    url: str, request: Dict[str, Any], timeout: float = 600.0
+) -> Dict[str, Any]:
+    """
+    Send a request to sd3_server.py and return its JSON response, which has "error" if the request failed.
+    url: base url of the server, eg. http://127.0.0.1:8000
+    """
+    req = urllib.request.Request(
+        url.rstrip("/") + "/generate",
+        data=json.dumps(request).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return json.loads(res.read())
+    except urllib.error.HTTPError as e:
+        # the server returns {"error": ...} for bad requests and failures
+        return json.loads(e.read())
+
+
+if __name__ == "__main__":
+    # python -m inferences.sd3_client --prompt "A photo of a cat" --seed 1 --save cat.png
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--prompt", type=str, default="A photo of a cat")
+    parser.add_argument("--negative_prompt", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=None)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--guidance_scale", type=float, default=None)
+    parser.add_argument(
+        "--save",
+        type=str,
+        default=None,
+        help="save the returned PNG bytes to this path. default: only print the path on the server",
+    )
+    args = parser.parse_args()
+
+    # unspecified parameters use the defaults of the server
+    request = {
+        key: getattr(args, key)
+        for key in [
+            "prompt",
+            "negative_prompt",
+            "seed",
+            "steps",
+            "width",
+            "height",
+            "guidance_scale",
+        ]
+        if getattr(args, key) is not None
+    }
+    request["return_image"] = args.save is not None
+
+    start_time = time.perf_counter()
+    response = generate(args.url, request)
+    elapsed = time.perf_counter() - start_time
+
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    if args.save is not None:
+        with open(args.save, "wb") as f:
+            f.write(base64.b64decode(response.pop("image")))
+        response["saved"] = args.save
+    response["round_trip"] = elapsed
+    print(json.dumps(response))
@@ -0,0 +1,66 @@
+import argparse
+
+import torch
+import logging
+from networks.stable_diffusion3 import sd3_utils
+from networks.stable_diffusion3.sd3_utils import setup_logging
+
+setup_logging()
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    # convert SD3 checkpoint(s) once to renamed and cast files for fast startup of sd3_inference.py:
+    # python -m inferences.sd3_export --ckpt_path sd3_medium.safetensors --bf16 --output_dir sd3_medium_bf16
+    # python -m inferences.sd3_inference --ckpt_path sd3_medium_bf16 --bf16 ...
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, required=True)
+    parser.add_argument("--clip_g", type=str, required=False)
+    parser.add_argument("--clip_l", type=str, required=False)
+    parser.add_argument("--t5xxl", type=str, required=False)
+    parser.add_argument("--vae", type=str, required=False)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--do_not_use_t5xxl", action="store_true")
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument(
+        "--t5xxl_dtype",
+        type=str,
+        default=None,
+        choices=list(sd3_utils.DTYPE_NAMES.values()),
+        help="dtype for t5xxl. default: same as other models",
+    )
+    args = parser.parse_args()
+
+    sd3_dtype = torch.float32
+    if args.fp16:
+        sd3_dtype = torch.float16
+    elif args.bf16:
+        sd3_dtype = torch.bfloat16
+    t5xxl_dtype = None
+    if args.t5xxl_dtype is not None:
+        t5xxl_dtype = {v: k for k, v in sd3_utils.DTYPE_NAMES.items()}[args.t5xxl_dtype]
+
+    # models are converted on CPU, attn_mode is not saved
+    mmdit, clip_l, clip_g, t5xxl, vae = sd3_utils.load_models(
+        args.ckpt_path,
+        args.clip_l,
+        args.clip_g,
+        args.t5xxl,
+        args.vae,
+        "torch",
+        "cpu",
+        sd3_dtype,
+        t5xxl_dtype=t5xxl_dtype,
+        use_t5xxl=not args.do_not_use_t5xxl,
+    )
+
+    sd3_utils.save_converted_models(
+        args.output_dir,
+        mmdit=mmdit,
+        clip_l=clip_l,
+        clip_g=clip_g,
+        t5xxl=t5xxl,
+        vae=vae,
+    )
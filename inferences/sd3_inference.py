@@ -4,15 +4,18 @@ import functools
 import math
 import os
 import random
-from typing import Optional, Tuple
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, Tuple, Union
 import numpy as np
 
 import torch
-from safetensors.torch import safe_open, load_file
 from tqdm import tqdm
 from PIL import Image
+from safetensors.torch import load_file, save_file
 import logging
-from networks.stable_diffusion3 import sd3_models, sd3_utils
+from networks.stable_diffusion3 import sd3_models, sd3_samplers, sd3_utils
 from networks.stable_diffusion3.sd3_utils import setup_logging
 
 setup_logging()
@@ -22,7 +25,8 @@ logger = logging.getLogger(__name__)
 
 
 def get_noise(seed: int, latent: torch.Tensor):
-    generator = torch.manual_seed(seed)
+    # use an own generator instead of seeding the global RNG
+    generator = torch.Generator(device="cpu").manual_seed(seed)
     return torch.randn(
         latent.size(),
         dtype=torch.float32,
@@ -40,28 +44,70 @@ def do_sample(
     height: int,
     width: int,
     initial_latent: Optional[torch.Tensor],
-    seed: int,
+    seed: Union[int, List[int]],
     cond: Tuple[torch.Tensor, torch.Tensor],
     neg_cond: Tuple[torch.Tensor, torch.Tensor],
     mmdit: sd3_models.MMDiT,
     steps: int,
-    guidance_scale: float,
+    guidance_scale: Union[float, torch.Tensor],
     dtype: torch.dtype,
     device: str,
+    sampler: str = "euler",
+    shift: float = 3.0,
+    sigma_spacing: str = "timestep",
+    cfg_interval: Optional[Tuple[float, float]] = None,
+    callback: Optional[
+        Callable[[int, torch.Tensor, torch.Tensor, torch.Tensor], None]
+    ] = None,
+    callback_steps: int = 1,
 ):
+    """
+    Sample a batch of latents with one MMDiT forward per step. The batch size is the batch size of cond, which may
+    hold a different prompt per sample. neg_cond has the same batch size, or 1 to share it in the batch.
+    seed: a list of seeds, one per sample, or a seed for the first sample (seed + i is used for the i-th sample).
+        The noise of each sample has its own generator, so a sample does not depend on the rest of the batch.
+    guidance_scale: a float, or a tensor of shape (batch_size,) to use a different scale per sample.
+    sampler: name of the sampler in sd3_samplers.SAMPLERS.
+    shift: timestep shift of the sigma schedule, SD3 is trained with 3.0.
+    sigma_spacing: spacing of the sigma schedule, one of sd3_utils.SIGMA_SPACINGS.
+    cfg_interval: (sigma_min, sigma_max) to apply CFG only at sigmas in the interval, only the conditional branch is
+        run at other sigmas. The unconditional branch is never run when guidance_scale is 1 for all samples.
+    callback: called as callback(step, timestep, latents, pred_x0) every callback_steps steps and at the last step,
+        latents is the latent after the step and pred_x0 the predicted final latent, both in the VAE latent space
+        like the returned latent. eg. for previews with sd3_models.LatentPreviewer.
+    """
+    if callback_steps < 1:
+        raise ValueError(f"callback_steps must be at least 1, got {callback_steps}")
+
+    batch_size = cond[0].shape[0]
+    if isinstance(seed, int):
+        seed = [seed + i for i in range(batch_size)]
+    assert len(seed) == batch_size, "number of seeds must match the batch size"
+    if neg_cond[0].shape[0] != batch_size:
+        neg_cond = tuple(c.expand(batch_size, *c.shape[1:]) for c in neg_cond)
+
     latent = initial_latent
     if initial_latent is None:
         latent = (
-            torch.ones(1, 16, height // 8, width // 8, device=device) * SHIFT_FACTOR
+            torch.ones(batch_size, 16, height // 8, width // 8, device=device)
+            * SHIFT_FACTOR
         )
 
     latent = latent.to(dtype).to(device)
 
-    noise = get_noise(seed, latent).to(device)
+    noise = torch.cat([get_noise(s, latent[i : i + 1]) for i, s in enumerate(seed)]).to(
+        device
+    )
 
-    model_sampling = sd3_utils.ModelSamplingDiscreteFlow()
+    if isinstance(guidance_scale, torch.Tensor):
+        use_cfg = not bool(torch.all(guidance_scale == 1.0))
+        guidance_scale = guidance_scale.to(device).view(-1, 1, 1, 1)
+    else:
+        use_cfg = guidance_scale != 1.0
 
-    sigmas = model_sampling.get_sigmas(steps).to(device)
+    model_sampling = sd3_utils.ModelSamplingDiscreteFlow(shift)
+
+    sigmas = model_sampling.get_sigmas(steps, sigma_spacing).to(device)
 
     x = model_sampling.noise_scaling(
         sigmas[0], noise, latent, model_sampling.max_denoise(sigmas)
@@ -71,271 +117,591 @@ def do_sample(
     c_crossattn = torch.cat([cond[0], neg_cond[0]]).to(device).to(dtype)
     y = torch.cat([cond[1], neg_cond[1]]).to(device).to(dtype)
 
+    # text conditioning is the same at every step, embed it once
     with torch.no_grad():
-        for i in tqdm(range(len(sigmas) - 1)):
-            sigma_hat = sigmas[i]
-
-            timestep = model_sampling.timestep(sigma_hat).float()
-            timestep = torch.FloatTensor([timestep, timestep]).to(device)
-
-            x_c_nc = torch.cat([x, x], dim=0)
-
-            model_output = mmdit(x_c_nc, timestep, context=c_crossattn, y=y)
-            model_output = model_output.float()
-            batched = model_sampling.calculate_denoised(sigma_hat, model_output, x)
-
-            pos_out, neg_out = batched.chunk(2)
-            denoised = neg_out + (pos_out - neg_out) * guidance_scale
+        conditioning = mmdit.prepare_conditioning(y, c_crossattn)
+    cond_only_conditioning = tuple(
+        c[:batch_size] if c is not None else None for c in conditioning
+    )
 
-            dims_to_append = x.ndim - sigma_hat.ndim
-            sigma_hat_dims = sigma_hat[(...,) + (None,) * dims_to_append]
-            d = (x - denoised) / sigma_hat_dims
+    num_model_evals = 0
+    num_cond_only_evals = 0
 
-            dt = sigmas[i + 1] - sigma_hat
+    def denoise(x: torch.Tensor, sigma: torch.Tensor) -> torch.Tensor:
+        nonlocal num_model_evals, num_cond_only_evals
+        num_model_evals += 1
 
-            # Euler method
-            x = x + d * dt
+        in_interval = cfg_interval is None or (
+            cfg_interval[0] <= float(sigma) <= cfg_interval[1]
+        )
+        if not (use_cfg and in_interval):
+            # conditional branch only, at half the batch
+            num_cond_only_evals += 1
             x = x.to(dtype)
+            timestep = model_sampling.timestep(sigma).float()
+            timestep = timestep.expand(x.shape[0]).to(device)
+            model_output = mmdit(
+                x, timestep, prepared_conditioning=cond_only_conditioning
+            )
+            return model_sampling.calculate_denoised(sigma, model_output.float(), x)
+
+        x_c_nc = torch.cat([x, x], dim=0).to(dtype)
+
+        timestep = model_sampling.timestep(sigma).float()
+        timestep = timestep.expand(x_c_nc.shape[0]).to(device)
+
+        model_output = mmdit(x_c_nc, timestep, prepared_conditioning=conditioning)
+        model_output = model_output.float()
+        batched = model_sampling.calculate_denoised(sigma, model_output, x_c_nc)
+
+        pos_out, neg_out = batched.chunk(2)
+        return neg_out + (pos_out - neg_out) * guidance_scale
+
+    feature_cache = mmdit.feature_cache
+    if feature_cache is not None:
+        feature_cache.reset()
+
+    sampler_callback = None
+    if callback is not None:
+        num_steps = len(sigmas) - 1
+
+        def sampler_callback(step, sigma, x, denoised):
+            if step % callback_steps == 0 or step == num_steps - 1:
+                callback(
+                    step,
+                    model_sampling.timestep(sigma),
+                    (x.float() / SCALE_FACTOR) + SHIFT_FACTOR,
+                    (denoised.float() / SCALE_FACTOR) + SHIFT_FACTOR,
+                )
+
+    with torch.no_grad():
+        x = sd3_samplers.SAMPLERS[sampler](denoise, x, sigmas, sampler_callback)
+    logger.info(
+        f"{sampler}: {steps} steps, {num_model_evals} model evaluations"
+        f" ({num_cond_only_evals} without CFG)"
+    )
+    if feature_cache is not None:
+        logger.info(
+            f"Feature cache: skipped blocks per model evaluation {feature_cache.skipped_blocks},"
+            f" {sum(feature_cache.skipped_blocks)} of {num_model_evals * len(mmdit.joint_blocks)} in total"
+        )
 
     latent = x
     latent = (latent / SCALE_FACTOR) + SHIFT_FACTOR
     return latent
 
 
-if __name__ == "__main__":
-    target_height = 1024
-    target_width = 1024
-    guidance_scale = 5
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--ckpt_path", type=str, required=True)
+def add_model_arguments(parser: argparse.ArgumentParser):
+    # models and how they are loaded and run, shared with sd3_server.py
+    parser.add_argument(
+        "--ckpt_path",
+        type=str,
+        required=True,
+        help="SD3 checkpoint file, or directory converted by sd3_export.py",
+    )
     parser.add_argument("--clip_g", type=str, required=False)
     parser.add_argument("--clip_l", type=str, required=False)
     parser.add_argument("--t5xxl", type=str, required=False)
-    parser.add_argument("--prompt", type=str, default="A photo of a cat")
-    # parser.add_argument("--prompt2", type=str, default=None)  # do not support different prompts for text encoders
-    parser.add_argument("--negative_prompt", type=str, default="")
-    parser.add_argument("--output_dir", type=str, default=".")
+    parser.add_argument("--vae", type=str, required=False)
+    parser.add_argument(
+        "--t5xxl_device",
+        type=str,
+        default=None,
+        help="device for t5xxl, eg. cpu. default: same as other models",
+    )
+    parser.add_argument(
+        "--t5xxl_dtype",
+        type=str,
+        default=None,
+        choices=list(sd3_utils.DTYPE_NAMES.values()),
+        help="dtype for t5xxl. default: same as other models, or the exported dtype for a converted directory",
+    )
+    parser.add_argument(
+        "--disable_mmap",
+        action="store_true",
+        help="read safetensors files into memory instead of memory-mapping them",
+    )
+    parser.add_argument(
+        "--load_workers",
+        type=int,
+        default=1,
+        help="number of threads to load separate model files concurrently. default: 1",
+    )
     parser.add_argument("--do_not_use_t5xxl", action="store_true")
     parser.add_argument(
         "--attn_mode",
         type=str,
         default="torch",
-        help="torch (SDPA) or xformers. default: torch",
+        choices=list(sd3_models.ATTENTION_BACKENDS.keys()),
+        help="attention backend, torch (SDPA), chunked (SDPA over query chunks), tiled (online softmax over query"
+        " and key chunks, memory linear in length), xformers or math. unavailable backends fall back to another one."
+        " default: torch",
+    )
+    parser.add_argument(
+        "--attention_chunk_size",
+        type=int,
+        default=1024,
+        help="chunk size of the chunked and tiled attention. default: 1024",
+    )
+    parser.add_argument(
+        "--feature_cache_threshold",
+        type=float,
+        default=None,
+        help="reuse the residual of an MMDiT block from a previous step when the relative change of its input is"
+        " below this, eg. 0.05. default: disabled",
+    )
+    parser.add_argument(
+        "--feature_cache_interval",
+        type=int,
+        default=None,
+        help="run cached MMDiT blocks only every N model evaluations and reuse their residuals in between."
+        " default: disabled",
+    )
+    parser.add_argument(
+        "--fuse_adaln",
+        action="store_true",
+        help="compute the adaLN modulation of all MMDiT blocks in one matmul per step",
+    )
+    parser.add_argument(
+        "--vae_precision",
+        type=str,
+        default="fp16",
+        choices=list(sd3_models.VAE_PRECISIONS.keys()),
+        help="autocast precision of the VAE, fp16 is used on CUDA only and bf16 on CUDA and CPU, other devices run"
+        " in the weight dtype. GroupNorm is computed in fp32. default: fp16",
+    )
+    parser.add_argument(
+        "--vae_optimize",
+        action="store_true",
+        help="run the VAE in channels_last with fused attention q/k/v, faster on CPU",
+    )
+    parser.add_argument(
+        "--vae_compile",
+        action="store_true",
+        help="compile the VAE with torch.compile, the first decode per image size is slow",
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="decode and encode with the VAE in overlapping tiles of this size in latent pixels (x8 in image pixels),"
+        " eg. 64, to save memory on large images. default: disabled",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="overlap of the VAE tiles in latent pixels. default: 16",
     )
     parser.add_argument("--fp16", action="store_true")
     parser.add_argument("--bf16", action="store_true")
-    parser.add_argument("--seed", type=int, default=1)
+
+
+def add_sampling_arguments(parser: argparse.ArgumentParser):
+    # defaults of a generation, shared with sd3_server.py where requests may override them
+    parser.add_argument("--prompt", type=str, default="A photo of a cat")
+    # parser.add_argument("--prompt2", type=str, default=None)  # do not support different prompts for text encoders
+    parser.add_argument("--negative_prompt", type=str, default="")
     parser.add_argument("--steps", type=int, default=50)
-    args = parser.parse_args()
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="euler",
+        choices=list(sd3_samplers.SAMPLERS.keys()),
+        help="sampler. heun and midpoint evaluate the model twice per step. default: euler",
+    )
+    parser.add_argument(
+        "--shift",
+        type=float,
+        default=3.0,
+        help="timestep shift of the sigma schedule. default: 3.0 (SD3)",
+    )
+    parser.add_argument(
+        "--sigma_spacing",
+        type=str,
+        default="timestep",
+        choices=sd3_utils.SIGMA_SPACINGS,
+        help="spacing of the sigma schedule. default: timestep",
+    )
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--guidance_scale", type=float, default=5.0)
+    parser.add_argument(
+        "--cfg_interval",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("SIGMA_MIN", "SIGMA_MAX"),
+        help="apply CFG only at sigmas in this interval, eg. 0.1 1.0. default: all steps",
+    )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    add_sampling_arguments(parser)
+    parser.add_argument(
+        "--prompt_file",
+        type=str,
+        default=None,
+        help="text file with one prompt per line, used instead of --prompt",
+    )
+    parser.add_argument(
+        "--num_images", type=int, default=1, help="number of images per prompt"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="number of images generated together in one batch. default: 1",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output_dir", type=str, default=".")
+    parser.add_argument(
+        "--image_format",
+        type=str,
+        default="png",
+        choices=list(IMAGE_FORMATS.keys()),
+        help="format of the saved images. default: png",
+    )
+    parser.add_argument(
+        "--png_compress_level",
+        type=int,
+        default=6,
+        help="PNG compression level 0-9, lower is faster and larger. default: 6",
+    )
+    parser.add_argument(
+        "--image_quality",
+        type=int,
+        default=95,
+        help="quality of WebP and JPEG images. default: 95",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="number of threads encoding and saving images in the background. default: 2",
+    )
+    parser.add_argument(
+        "--preview_steps",
+        type=int,
+        default=None,
+        help="save a preview of the predicted image every N steps at 1/8 resolution to output_dir, overwritten"
+        " each time. the preview is a linear approximation of the VAE fitted to the first batch, so the first batch"
+        " is not previewed unless --previewer_path exists. default: disabled",
+    )
+    parser.add_argument(
+        "--previewer_path",
+        type=str,
+        default=None,
+        help="safetensors file of the fitted previewer, loaded if it exists and saved after the first batch otherwise",
+    )
+    return parser
 
-    seed = args.seed
-    steps = args.steps
 
-    sd3_dtype = torch.float32
+def get_sd3_dtype(args: argparse.Namespace) -> torch.dtype:
     if args.fp16:
-        sd3_dtype = torch.float16
+        return torch.float16
     elif args.bf16:
-        sd3_dtype = torch.bfloat16
+        return torch.bfloat16
+    return torch.float32
 
-    # TODO test with separated safetenors files for each model
 
-    # load state dict
-    logger.info(f"Loading SD3 models from {args.ckpt_path}...")
-    state_dict = load_file(args.ckpt_path)
+def get_t5xxl_dtype(args: argparse.Namespace) -> Optional[torch.dtype]:
+    if args.t5xxl_dtype is None:
+        return None
+    return {v: k for k, v in sd3_utils.DTYPE_NAMES.items()}[args.t5xxl_dtype]
 
-    if (
-        "text_encoders.clip_g.transformer.text_model.embeddings.position_embedding.weight"
-        in state_dict
-    ):
-        # found clip_g: remove prefix "text_encoders.clip_g."
-        logger.info("clip_g is included in the checkpoint")
-        clip_g_sd = {}
-        prefix = "text_encoders.clip_g."
-        for k, v in list(state_dict.items()):
-            if k.startswith(prefix):
-                clip_g_sd[k[len(prefix) :]] = state_dict.pop(k)
-    else:
-        logger.info(f"Lodaing clip_g from {args.clip_g}...")
-        clip_g_sd = load_file(args.clip_g)
-        for key in list(clip_g_sd.keys()):
-            clip_g_sd["transformer." + key] = clip_g_sd.pop(key)
 
-    if (
-        "text_encoders.clip_l.transformer.text_model.embeddings.position_embedding.weight"
-        in state_dict
-    ):
-        # found clip_l: remove prefix "text_encoders.clip_l."
-        logger.info("clip_l is included in the checkpoint")
-        clip_l_sd = {}
-        prefix = "text_encoders.clip_l."
-        for k, v in list(state_dict.items()):
-            if k.startswith(prefix):
-                clip_l_sd[k[len(prefix) :]] = state_dict.pop(k)
-    else:
-        logger.info(f"Lodaing clip_l from {args.clip_l}...")
-        clip_l_sd = load_file(args.clip_l)
-        for key in list(clip_l_sd.keys()):
-            clip_l_sd["transformer." + key] = clip_l_sd.pop(key)
+def load_inference_models(
+    args: argparse.Namespace, device: torch.device, sd3_dtype: torch.dtype
+):
+    """
+    Load tokenizer and models in eval mode. Returns (tokenizer, mmdit, clip_l, clip_g, t5xxl, vae).
+    """
+    sd3_models.set_attention_chunk_size(args.attention_chunk_size)
+
+    # load models directly in the target device and dtype
+    mmdit, clip_l, clip_g, t5xxl, vae = sd3_utils.load_models(
+        args.ckpt_path,
+        args.clip_l,
+        args.clip_g,
+        args.t5xxl,
+        args.vae,
+        args.attn_mode,
+        device,
+        sd3_dtype,
+        disable_mmap=args.disable_mmap,
+        t5xxl_device=args.t5xxl_device,
+        t5xxl_dtype=get_t5xxl_dtype(args),
+        use_t5xxl=not args.do_not_use_t5xxl,
+        max_workers=args.load_workers,
+    )
+    mmdit.eval()
+    if args.fuse_adaln:
+        mmdit.fuse_adaln_modulation()
+    if args.feature_cache_threshold is not None or args.feature_cache_interval:
+        threshold = args.feature_cache_threshold or 0.0
+        feature_cache = sd3_models.MMDiTFeatureCache(
+            threshold, args.feature_cache_interval
+        )
+        mmdit.enable_feature_cache(feature_cache)
+    vae.eval()
+    vae.set_precision(args.vae_precision)
+    if args.vae_optimize or args.vae_compile:
+        vae.optimize_for_inference(
+            channels_last=args.vae_optimize,
+            fuse_qkv=args.vae_optimize,
+            compile=args.vae_compile,
+        )
+    if args.vae_tile_size is not None:
+        vae.enable_tiling(args.vae_tile_size, args.vae_tile_overlap)
+    clip_l.eval()
+    clip_g.eval()
+    if t5xxl is not None:
+        t5xxl.eval()
 
-    if (
-        "text_encoders.t5xxl.transformer.encoder.block.0.layer.0.SelfAttention.k.weight"
-        in state_dict
-    ):
-        # found t5xxl: remove prefix "text_encoders.t5xxl."
-        logger.info("t5xxl is included in the checkpoint")
-        if not args.do_not_use_t5xxl:
-            t5xxl_sd = {}
-            prefix = "text_encoders.t5xxl."
-            for k, v in list(state_dict.items()):
-                if k.startswith(prefix):
-                    t5xxl_sd[k[len(prefix) :]] = state_dict.pop(k)
-        else:
-            logger.info("but not used")
-            for key in list(state_dict.keys()):
-                if key.startswith("text_encoders.t5xxl."):
-                    state_dict.pop(key)
-            t5xxl_sd = None
-    elif args.t5xxl:
-        assert not args.do_not_use_t5xxl, "t5xxl is not used but specified"
-        logger.info(f"Lodaing t5xxl from {args.t5xxl}...")
-        t5xxl_sd = load_file(args.t5xxl)
-        for key in list(t5xxl_sd.keys()):
-            t5xxl_sd["transformer." + key] = t5xxl_sd.pop(key)
-    else:
-        logger.info("t5xxl is not used")
-        t5xxl_sd = None
+    # load tokenizers
+    logger.info("Loading tokenizers...")
+    start_time = time.perf_counter()
+    tokenizer = sd3_models.SD3Tokenizer(t5xxl is not None)  # combined tokenizer
+    logger.info(f"Loaded tokenizers in {time.perf_counter() - start_time:.2f}s")
 
-    use_t5xxl = t5xxl_sd is not None
+    return tokenizer, mmdit, clip_l, clip_g, t5xxl, vae
 
-    # MMDiT and VAE
-    vae_sd = {}
-    vae_prefix = "first_stage_model."
-    mmdit_prefix = "model.diffusion_model."
-    for k, v in list(state_dict.items()):
-        if k.startswith(vae_prefix):
-            vae_sd[k[len(vae_prefix) :]] = state_dict.pop(k)
-        elif k.startswith(mmdit_prefix):
-            state_dict[k[len(mmdit_prefix) :]] = state_dict.pop(k)
 
-    # load tokenizers
-    logger.info("Loading tokenizers...")
-    tokenizer = sd3_models.SD3Tokenizer(use_t5xxl)  # combined tokenizer
+def encode_prompt(
+    prompt: str,
+    tokenizer: sd3_models.SD3Tokenizer,
+    clip_l: sd3_models.SDClipModel,
+    clip_g: sd3_models.SDXLClipG,
+    t5xxl: Optional[sd3_models.T5XXLModel],
+    device: torch.device,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # embeds, pooled_embed
+    lg_out, t5_out, pooled = sd3_utils.get_cond(
+        prompt, tokenizer, clip_l, clip_g, t5xxl
+    )
+    return torch.cat([lg_out, t5_out], dim=-2).to(device), pooled.to(device)
 
-    # load models
-    # logger.info("Create MMDiT from SD3 checkpoint...")
-    # mmdit = sd3_utils.create_mmdit_from_sd3_checkpoint(state_dict)
-    logger.info("Create MMDiT")
-    mmdit = sd3_models.create_mmdit_sd3_medium_configs(args.attn_mode)
 
-    logger.info("Loading state dict...")
-    info = mmdit.load_state_dict(state_dict)
-    logger.info(f"Loaded MMDiT: {info}")
+def to_uint8_images(images: torch.Tensor) -> np.ndarray:
+    """
+    Convert images in [-1, 1] of shape (B, C, H, W) to uint8 of shape (B, H, W, C) on their device, and transfer the
+    uint8 images (1/4 of float32) to CPU at once.
+    """
+    images = images.float().add(1.0).div_(2.0).clamp_(0.0, 1.0).mul_(255.0)
+    images = images.to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+    return images.cpu().numpy()
 
-    logger.info(f"Move MMDiT to {device} and {sd3_dtype}...")
-    mmdit.to(device, dtype=sd3_dtype)
-    mmdit.eval()
 
-    # load VAE
-    logger.info("Create VAE")
-    vae = sd3_models.SDVAE()
-    logger.info("Loading state dict...")
-    info = vae.load_state_dict(vae_sd)
-    logger.info(f"Loaded VAE: {info}")
+def to_pil_images(images: torch.Tensor) -> List[Image.Image]:
+    # images in [-1, 1]
+    return [Image.fromarray(image) for image in to_uint8_images(images)]
 
-    logger.info(f"Move VAE to {device} and {sd3_dtype}...")
-    vae.to(device, dtype=sd3_dtype)
-    vae.eval()
 
-    # load text encoders
-    logger.info("Create clip_l")
-    clip_l = sd3_models.create_clip_l(device, sd3_dtype, clip_l_sd)
+def decode_images(vae: sd3_models.SDVAE, latent: torch.Tensor) -> List[Image.Image]:
+    # decoded in slices fitting in memory, see SDVAE.iter_decode
+    pil_images = []
+    with torch.no_grad():
+        for images in vae.iter_decode(latent):
+            pil_images.extend(to_pil_images(images))
+    return pil_images
 
-    logger.info("Loading state dict...")
-    info = clip_l.load_state_dict(clip_l_sd)
-    logger.info(f"Loaded clip_l: {info}")
 
-    logger.info(f"Move clip_l to {device} and {sd3_dtype}...")
-    clip_l.to(device, dtype=sd3_dtype)
-    clip_l.eval()
-    logger.info(f"Set attn_mode to {args.attn_mode}...")
-    clip_l.set_attn_mode(args.attn_mode)
+IMAGE_FORMATS = {"png": "PNG", "webp": "WEBP", "jpg": "JPEG"}
 
-    logger.info("Create clip_g")
-    clip_g = sd3_models.create_clip_g(device, sd3_dtype, clip_g_sd)
 
-    logger.info("Loading state dict...")
-    info = clip_g.load_state_dict(clip_g_sd)
-    logger.info(f"Loaded clip_g: {info}")
+class ImageWriter:
+    """
+    Encodes and saves images on a thread pool, so that the next batch is sampled while the previous images are
+    written. PIL releases the GIL while compressing. At most max_pending images are queued, submit blocks beyond.
+    image_format: a key of IMAGE_FORMATS. compress_level is for PNG (0-9), quality for WebP and JPEG.
+    """
+
+    def __init__(
+        self,
+        image_format: str = "png",
+        compress_level: int = 6,
+        quality: int = 95,
+        max_workers: int = 2,
+        max_pending: int = 8,
+    ):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"unknown image format: {image_format}")
+        self.image_format = image_format
+        if image_format == "png":
+            self.save_kwargs = {"compress_level": compress_level}
+        else:
+            self.save_kwargs = {"quality": quality}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures: List[Future] = []
+
+    @property
+    def extension(self) -> str:
+        return "." + self.image_format
+
+    def _save(self, image: Image.Image, path: str) -> str:
+        try:
+            image.save(path, IMAGE_FORMATS[self.image_format], **self.save_kwargs)
+            logger.info(f"Saved image to {path}")
+            return path
+        finally:
+            self.pending.release()
+
+    def submit(self, image: Image.Image, path: str) -> Future:
+        # path without extension, the extension of the format is added
+        self.pending.acquire()
+        future = self.executor.submit(self._save, image, path + self.extension)
+        # drop the finished writes, failed ones are kept to raise their error in close
+        self.futures = [
+            f for f in self.futures if not f.done() or f.exception() is not None
+        ]
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        # wait for all images, then raise the error of the first failed write
+        try:
+            wait(self.futures)
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def fit_latent_previewer(
+    latents: torch.Tensor, images: List[Image.Image]
+) -> sd3_models.LatentPreviewer:
+    # fitted to a generated batch, whose images are already decoded
+    pixels = torch.from_numpy(np.stack([np.asarray(image) for image in images]))
+    pixels = pixels.permute(0, 3, 1, 2).float() / 127.5 - 1.0
+    previewer = sd3_models.LatentPreviewer().fit(latents.float().cpu(), pixels)
+    return previewer.to(latents.device).eval()
 
-    logger.info(f"Move clip_g to {device} and {sd3_dtype}...")
-    clip_g.to(device, dtype=sd3_dtype)
-    clip_g.eval()
-    logger.info(f"Set attn_mode to {args.attn_mode}...")
-    clip_g.set_attn_mode(args.attn_mode)
 
-    if use_t5xxl:
-        logger.info("Create t5xxl")
-        t5xxl = sd3_models.create_t5xxl(t5xxl_sd, device, sd3_dtype)
+if __name__ == "__main__":
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        logger.info("Loading state dict...")
-        info = t5xxl.load_state_dict(t5xxl_sd)
-        logger.info(f"Loaded t5xxl: {info}")
+    parser = setup_parser()
+    args = parser.parse_args()
+    if args.preview_steps is not None and args.preview_steps < 1:
+        parser.error("--preview_steps must be at least 1")
 
-        logger.info(f"Move t5xxl to {device} and {sd3_dtype}...")
-        t5xxl.to(device, dtype=sd3_dtype)
-        # t5xxl.to("cpu", dtype=torch.float32) # run on CPU
-        t5xxl.eval()
-        logger.info(f"Set attn_mode to {args.attn_mode}...")
-        t5xxl.set_attn_mode(args.attn_mode)
+    steps = args.steps
+    sd3_dtype = get_sd3_dtype(args)
+
+    if args.prompt_file is not None:
+        with open(args.prompt_file, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
     else:
-        t5xxl = None
+        prompts = [args.prompt]
+    # the n-th image uses seed + n regardless of the batch it is generated in
+    prompts = [prompt for prompt in prompts for _ in range(args.num_images)]
+    seeds = [args.seed + i for i in range(len(prompts))]
 
-    # prepare embeddings
-    logger.info("Encoding prompts...")
-    # embeds, pooled_embed
-    lg_out, t5_out, pooled = sd3_utils.get_cond(
-        args.prompt, tokenizer, clip_l, clip_g, t5xxl
+    tokenizer, mmdit, clip_l, clip_g, t5xxl, vae = load_inference_models(
+        args, device, sd3_dtype
     )
-    cond = torch.cat([lg_out, t5_out], dim=-2).to(device), pooled.to(device)
 
-    lg_out, t5_out, pooled = sd3_utils.get_cond(
-        args.negative_prompt, tokenizer, clip_l, clip_g, t5xxl
-    )
-    neg_cond = torch.cat([lg_out, t5_out], dim=-2).to(device), pooled.to(device)
-
-    # generate image
-    logger.info("Generating image...")
-    latent_sampled = do_sample(
-        target_height,
-        target_width,
-        None,
-        seed,
-        cond,
-        neg_cond,
-        mmdit,
-        steps,
-        guidance_scale,
-        sd3_dtype,
-        device,
+    # prepare embeddings
+    logger.info("Encoding prompts...")
+    prompt_conds = {}
+    for prompt in prompts:
+        if prompt not in prompt_conds:
+            prompt_conds[prompt] = encode_prompt(
+                prompt, tokenizer, clip_l, clip_g, t5xxl, device
+            )
+    neg_cond = encode_prompt(
+        args.negative_prompt, tokenizer, clip_l, clip_g, t5xxl, device
     )
 
-    with torch.no_grad():
-        image = vae.decode(latent_sampled)
-    image = image.float()
-    image = torch.clamp((image + 1.0) / 2.0, min=0.0, max=1.0)[0]
-    decoded_np = 255.0 * np.moveaxis(image.cpu().numpy(), 0, 2)
-    decoded_np = decoded_np.astype(np.uint8)
-    out_image = Image.fromarray(decoded_np)
-
-    # save image
     output_dir = args.output_dir
     os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(
-        output_dir, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    )
-    out_image.save(output_path)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    logger.info(f"Saved image to {output_path}")
+    previewer = None
+    if (
+        args.preview_steps is not None
+        and args.previewer_path is not None
+        and os.path.exists(args.previewer_path)
+    ):
+        logger.info(f"Loading latent previewer from {args.previewer_path}")
+        previewer = sd3_models.LatentPreviewer()
+        previewer.load_state_dict(load_file(args.previewer_path))
+        previewer = previewer.to(device).eval()
+
+    with ImageWriter(
+        args.image_format,
+        args.png_compress_level,
+        args.image_quality,
+        args.writer_workers,
+    ) as writer:
+        for start in range(0, len(prompts), args.batch_size):
+            batch_prompts = prompts[start : start + args.batch_size]
+            batch_seeds = seeds[start : start + args.batch_size]
+            cond = tuple(
+                torch.cat(c) for c in zip(*[prompt_conds[p] for p in batch_prompts])
+            )
+
+            callback = None
+            if previewer is not None:
+
+                def callback(step, timestep, latents, pred_x0):
+                    with torch.no_grad():
+                        previews = to_pil_images(previewer(pred_x0))
+                    for i, preview in enumerate(previews):
+                        preview_path = os.path.join(
+                            output_dir, f"{timestamp}_{start + i:04d}_preview.png"
+                        )
+                        preview.save(preview_path)
+                    logger.info(f"Saved previews of step {step + 1}")
+
+            # generate images
+            logger.info(
+                f"Generating images {start + 1}-{start + len(batch_prompts)}..."
+            )
+            latent_sampled = do_sample(
+                args.height,
+                args.width,
+                None,
+                batch_seeds,
+                cond,
+                neg_cond,
+                mmdit,
+                steps,
+                args.guidance_scale,
+                sd3_dtype,
+                device,
+                args.sampler,
+                args.shift,
+                args.sigma_spacing,
+                args.cfg_interval,
+                callback,
+                1 if args.preview_steps is None else args.preview_steps,
+            )
+
+            out_images = decode_images(vae, latent_sampled)
+            if args.preview_steps is not None and previewer is None:
+                logger.info("Fitting latent previewer to the first batch...")
+                previewer = fit_latent_previewer(latent_sampled, out_images)
+                if args.previewer_path is not None:
+                    save_file(previewer.state_dict(), args.previewer_path)
+
+            # save images in the background
+            for i, out_image in enumerate(out_images):
+                if len(prompts) == 1:
+                    output_path = os.path.join(output_dir, timestamp)
+                else:
+                    output_path = os.path.join(
+                        output_dir, f"{timestamp}_{start + i:04d}_{batch_seeds[i]}"
+                    )
+                writer.submit(out_image, output_path)
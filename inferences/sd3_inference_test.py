@@ -0,0 +1,245 @@
+import pytest
+import torch
+
+import numpy as np
+from PIL import Image
+
+from inferences import sd3_inference
+from inferences.sd3_inference import do_sample
+from networks.stable_diffusion3.sd3_test_utils import create_tiny_mmdit
+
+
+@pytest.fixture
+def mmdit():
+    return create_tiny_mmdit()
+
+
+def make_cond(num_prompts, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return (
+        torch.randn(num_prompts, 8, 64, generator=generator),
+        torch.randn(num_prompts, 32, generator=generator),
+    )
+
+
+def sample(mmdit, cond, neg_cond, seed, guidance_scale=5.0, cfg_interval=None):
+    return do_sample(
+        32,
+        32,
+        None,
+        seed,
+        cond,
+        neg_cond,
+        mmdit,
+        4,
+        guidance_scale,
+        torch.float32,
+        "cpu",
+        cfg_interval=cfg_interval,
+    )
+
+
+def test_do_sample_independent_of_batch_composition(mmdit):
+    cond = make_cond(3, 0)
+    neg_cond = make_cond(1, 1)
+
+    batched = sample(mmdit, cond, neg_cond, [10, 11, 12])
+    assert batched.shape == (3, 16, 4, 4)
+
+    for i, seed in enumerate([10, 11, 12]):
+        single = sample(mmdit, tuple(c[i : i + 1] for c in cond), neg_cond, seed)
+        assert torch.allclose(batched[i : i + 1], single, atol=1e-5)
+
+    # an int seed is the seed of the first sample
+    assert torch.allclose(sample(mmdit, cond, neg_cond, 10), batched, atol=1e-5)
+
+
+def test_do_sample_per_sample_guidance_scale(mmdit):
+    cond = make_cond(2, 0)
+    neg_cond = make_cond(2, 1)
+
+    batched = sample(mmdit, cond, neg_cond, [1, 2], torch.tensor([1.0, 7.0]))
+    first = sample(
+        mmdit, tuple(c[:1] for c in cond), tuple(c[:1] for c in neg_cond), 1, 1.0
+    )
+    second = sample(
+        mmdit, tuple(c[1:] for c in cond), tuple(c[1:] for c in neg_cond), 2, 7.0
+    )
+    assert torch.allclose(batched, torch.cat([first, second]), atol=1e-5)
+
+
+def test_do_sample_cfg_interval(mmdit):
+    cond = make_cond(2, 0)
+    neg_cond = make_cond(1, 1)
+
+    full = sample(mmdit, cond, neg_cond, 1)
+    assert torch.allclose(
+        sample(mmdit, cond, neg_cond, 1, cfg_interval=(0.0, 1.0)), full
+    )
+
+    # outside the interval only the conditional branch is run, same as guidance_scale 1
+    no_cfg = sample(mmdit, cond, neg_cond, 1, cfg_interval=(2.0, 3.0))
+    assert torch.allclose(no_cfg, sample(mmdit, cond, neg_cond, 1, 1.0), atol=1e-5)
+    assert not torch.allclose(no_cfg, full, atol=1e-3)
+
+    partial = sample(mmdit, cond, neg_cond, 1, cfg_interval=(0.0, 0.9))
+    assert not torch.allclose(partial, full, atol=1e-4)
+    assert not torch.allclose(partial, no_cfg, atol=1e-4)
+
+
+def test_do_sample_skips_uncond_at_guidance_scale_1(mmdit):
+    cond = make_cond(2, 0)
+    neg_cond = make_cond(1, 1)
+
+    batch_sizes = []
+    handle = mmdit.register_forward_pre_hook(
+        lambda module, args: batch_sizes.append(args[0].shape[0])
+    )
+    sample(mmdit, cond, neg_cond, 1, torch.tensor([1.0, 1.0]))
+    handle.remove()
+    assert batch_sizes == [2] * 4
+
+
+def test_do_sample_callback(mmdit):
+    cond = make_cond(1, 0)
+    neg_cond = make_cond(1, 1)
+    calls = []
+
+    def callback(step, timestep, latents, pred_x0):
+        calls.append((step, float(timestep), latents, pred_x0))
+
+    latent = do_sample(
+        32,
+        32,
+        None,
+        0,
+        cond,
+        neg_cond,
+        mmdit,
+        4,
+        5.0,
+        torch.float32,
+        "cpu",
+        callback=callback,
+        callback_steps=2,
+    )
+    # every 2 steps and the last step
+    assert [step for step, *_ in calls] == [0, 2, 3]
+    assert calls[0][1] == pytest.approx(1000.0)
+    # latents are in the same space as the result
+    assert torch.allclose(calls[-1][2], latent, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        do_sample(
+            32,
+            32,
+            None,
+            0,
+            cond,
+            neg_cond,
+            mmdit,
+            4,
+            5.0,
+            torch.float32,
+            "cpu",
+            callback=callback,
+            callback_steps=0,
+        )
+
+
+def test_fit_latent_previewer():
+    # fitted to the decoded images of a batch, up to the uint8 quantization
+    weight = torch.randn(3, 16, 1, 1) * 0.1
+    latents = torch.randn(2, 16, 4, 4)
+    images = torch.nn.functional.conv2d(latents, weight).clamp(-1, 1)
+    images = torch.nn.functional.interpolate(images, scale_factor=8)
+    previewer = sd3_inference.fit_latent_previewer(
+        latents, sd3_inference.to_pil_images(images)
+    )
+    assert torch.allclose(previewer.proj.weight, weight, atol=0.02)
+
+
+class StubTokenizer:
+    def tokenize_with_weights(self, prompt):
+        return "l", "g", "t5"
+
+
+class StubTextEncoder:
+    def __init__(self, out_dim, device, dtype, pooled_dim=None):
+        self.out_dim = out_dim
+        self.device = device
+        self.dtype = dtype
+        self.pooled_dim = pooled_dim
+
+    def encode_token_weights(self, tokens):
+        out = torch.zeros(1, 77, self.out_dim, device=self.device, dtype=self.dtype)
+        pooled = None
+        if self.pooled_dim is not None:
+            pooled = torch.zeros(
+                1, self.pooled_dim, device=self.device, dtype=self.dtype
+            )
+        return out, pooled
+
+
+def test_encode_prompt_t5xxl_on_another_device():
+    # T5XXL on CPU in fp32 (--t5xxl_device cpu), CLIP on another device in bf16. meta stands for the GPU
+    device = torch.device("meta")
+    clip_l = StubTextEncoder(768, device, torch.bfloat16, pooled_dim=768)
+    clip_g = StubTextEncoder(1280, device, torch.bfloat16, pooled_dim=1280)
+    t5xxl = StubTextEncoder(4096, "cpu", torch.float32)
+
+    cond, pooled = sd3_inference.encode_prompt(
+        "a prompt", StubTokenizer(), clip_l, clip_g, t5xxl, device
+    )
+    assert cond.shape == (1, 154, 4096)
+    assert cond.device == device and cond.dtype == torch.bfloat16
+    assert pooled.shape == (1, 2048)
+
+
+def test_to_uint8_images():
+    images = torch.randn(2, 3, 8, 8)
+    # the previous conversion on CPU
+    expected = torch.clamp((images + 1.0) / 2.0, min=0.0, max=1.0)
+    expected = (255.0 * np.moveaxis(expected.numpy(), 1, 3)).astype(np.uint8)
+    assert np.array_equal(sd3_inference.to_uint8_images(images), expected)
+
+
+@pytest.mark.parametrize("image_format", ["png", "webp", "jpg"])
+def test_image_writer(tmp_path, image_format):
+    images = sd3_inference.to_pil_images(torch.rand(3, 3, 16, 16) * 2 - 1)
+    with sd3_inference.ImageWriter(image_format, compress_level=1) as writer:
+        futures = [
+            writer.submit(image, str(tmp_path / f"{i}"))
+            for i, image in enumerate(images)
+        ]
+    paths = [future.result() for future in futures]
+    assert paths == [str(tmp_path / f"{i}.{image_format}") for i in range(3)]
+    for image, path in zip(images, paths):
+        with Image.open(path) as saved:
+            assert saved.size == (16, 16)
+            if image_format == "png":
+                assert np.array_equal(np.asarray(saved), np.asarray(image))
+
+
+def test_image_writer_errors(tmp_path):
+    with pytest.raises(ValueError):
+        sd3_inference.ImageWriter("bmp")
+
+    image = sd3_inference.to_pil_images(torch.zeros(1, 3, 4, 4))[0]
+    writer = sd3_inference.ImageWriter()
+    writer.submit(image, str(tmp_path / "missing" / "image"))
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+    # the error of a finished write is kept after later successful writes
+    writer = sd3_inference.ImageWriter()
+    failed = writer.submit(image, str(tmp_path / "missing" / "image"))
+    assert isinstance(failed.exception(), FileNotFoundError)
+    writer.submit(image, str(tmp_path / "image")).result()
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+    assert (tmp_path / "image.png").exists()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,65 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from inferences.sd3_client import generate
+
+if __name__ == "__main__":
+    # python -m inferences.sd3_loadgen --num_requests 32 --concurrency 4 --steps 28
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--num_requests", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--prompts",
+        type=str,
+        nargs="+",
+        default=["A photo of a cat", "A photo of a dog", "A watercolor landscape"],
+        help="prompts used in turn",
+    )
+    parser.add_argument("--steps", type=int, default=None)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    args = parser.parse_args()
+
+    def send(i: int):
+        request = {"prompt": args.prompts[i % len(args.prompts)], "seed": i}
+        for key in ["steps", "width", "height"]:
+            if getattr(args, key) is not None:
+                request[key] = getattr(args, key)
+        start_time = time.perf_counter()
+        try:
+            response = generate(args.url, request)
+            ok = "error" not in response
+        except Exception as e:
+            print(f"request {i} failed: {e}")
+            ok = False
+        return ok, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.num_requests)))
+    total = time.perf_counter() - start_time
+
+    latencies = np.array([latency for ok, latency in results if ok])
+    num_ok = len(latencies)
+    summary = {
+        "requests": args.num_requests,
+        "succeeded": num_ok,
+        "concurrency": args.concurrency,
+        "total_sec": round(total, 3),
+        "images_per_sec": round(num_ok / total, 4),
+    }
+    if num_ok > 0:
+        summary.update(
+            {
+                "latency_mean": round(float(latencies.mean()), 3),
+                "latency_p50": round(float(np.percentile(latencies, 50)), 3),
+                "latency_p95": round(float(np.percentile(latencies, 95)), 3),
+                "latency_max": round(float(latencies.max()), 3),
+            }
+        )
+    print(json.dumps(summary, indent=2))
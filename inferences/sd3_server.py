@@ -0,0 +1,393 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import sys
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import torch
+from PIL import Image
+import logging
+from inferences import sd3_inference
+from networks.stable_diffusion3 import sd3_samplers
+from networks.stable_diffusion3.sd3_utils import setup_logging
+
+setup_logging()
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Collects concurrent requests with the same batch key into one batch and runs them together.
+    A batch is run when it has max_batch_size requests or when max_wait seconds have passed since its first request
+    arrived. Requests with other keys wait for a later batch in arrival order.
+    clock: returns the current time in seconds, replaceable for tests. Notify condition after changing its time.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Dict[str, Any]]], List[Any]],
+        max_batch_size: int,
+        max_wait: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.clock = clock
+        self.condition = threading.Condition()
+        # (key, params, future, arrival time)
+        self.pending: List[Tuple[Hashable, Dict[str, Any], Future, float]] = []
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, key: Hashable, params: Dict[str, Any]) -> Future:
+        future = Future()
+        with self.condition:
+            self.pending.append((key, params, future, self.clock()))
+            self.condition.notify()
+        return future
+
+    def _next_batch(self) -> List[Tuple[Hashable, Dict[str, Any], Future, float]]:
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            # the oldest request may have waited during the previous batch already
+            key, _, _, arrival_time = self.pending[0]
+            deadline = arrival_time + self.max_wait
+            while True:
+                batch = [item for item in self.pending if item[0] == key]
+                batch = batch[: self.max_batch_size]
+                remaining = deadline - self.clock()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            for item in batch:
+                self.pending.remove(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            futures = [future for _, _, future, _ in batch]
+            try:
+                results = self.run_batch([params for _, params, _, _ in batch])
+            except Exception as e:
+                logger.exception("failed to generate")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+class SD3Server:
+    """
+    Keeps SD3 models resident and generates an image per request.
+    A request is a dict with optional keys: prompt, negative_prompt, seed, steps, width, height, guidance_scale,
+    sampler and return_image. Missing keys fall back to the command line arguments, a missing seed is chosen randomly.
+    Concurrent requests with the same size, steps and sampler are batched into one MMDiT forward per step.
+    """
+
+    def __init__(self, args: argparse.Namespace, device: torch.device):
+        self.args = args
+        self.device = device
+        self.sd3_dtype = sd3_inference.get_sd3_dtype(args)
+        (
+            self.tokenizer,
+            self.mmdit,
+            self.clip_l,
+            self.clip_g,
+            self.t5xxl,
+            self.vae,
+        ) = self.load_models()
+        # the positional embedding of MMDiT covers pos_embed_max_size patches of 2x2 latent pixels
+        self.max_size = None
+        if self.mmdit.pos_embed_max_size is not None:
+            self.max_size = self.mmdit.pos_embed_max_size * self.mmdit.patch_size * 8
+        self.scheduler = BatchScheduler(
+            self.generate_batch, args.max_batch_size, args.max_wait_ms / 1000.0
+        )
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    def load_models(self):
+        # (tokenizer, mmdit, clip_l, clip_g, t5xxl, vae), replaceable for tests
+        return sd3_inference.load_inference_models(
+            self.args, self.device, self.sd3_dtype
+        )
+
+    def parse_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        args = self.args
+        params = {
+            "prompt": str(request.get("prompt", args.prompt)),
+            "negative_prompt": str(
+                request.get("negative_prompt", args.negative_prompt)
+            ),
+            "seed": int(request.get("seed", random.randint(0, 2**32 - 1))),
+            "steps": int(request.get("steps", args.steps)),
+            "width": int(request.get("width", args.width)),
+            "height": int(request.get("height", args.height)),
+            "guidance_scale": float(request.get("guidance_scale", args.guidance_scale)),
+            "sampler": str(request.get("sampler", args.sampler)),
+            "return_image": request.get("return_image", False),
+        }
+        # a string such as "false" would be true
+        if not isinstance(params["return_image"], bool):
+            raise ValueError("return_image must be true or false")
+        # latent is 1/8 of the image and MMDiT patch size is 2
+        for name in ("width", "height"):
+            size = params[name]
+            if size < 16 or size % 16 != 0:
+                raise ValueError(f"{name} must be a positive multiple of 16")
+            if self.max_size is not None and size > self.max_size:
+                raise ValueError(f"{name} must be at most {self.max_size}")
+        if params["steps"] < 1:
+            raise ValueError("steps must be positive")
+        if params["sampler"] not in sd3_samplers.SAMPLERS:
+            raise ValueError(f"unknown sampler: {params['sampler']}")
+        return params
+
+    @staticmethod
+    def batch_key(params: Dict[str, Any]) -> Hashable:
+        # requests in a batch must share the latent size, the sigma schedule and the sampler
+        return (params["height"], params["width"], params["steps"], params["sampler"])
+
+    def generate_batch(self, batch: List[Dict[str, Any]]) -> List[Image.Image]:
+        """
+        Generate images for requests with the same batch key. Called from the scheduler thread only.
+        """
+        logger.info(f"Generating a batch of {len(batch)}")
+        conds = []
+        neg_conds = []
+        for params in batch:
+            conds.append(
+                sd3_inference.encode_prompt(
+                    params["prompt"],
+                    self.tokenizer,
+                    self.clip_l,
+                    self.clip_g,
+                    self.t5xxl,
+                    self.device,
+                )
+            )
+            neg_conds.append(
+                sd3_inference.encode_prompt(
+                    params["negative_prompt"],
+                    self.tokenizer,
+                    self.clip_l,
+                    self.clip_g,
+                    self.t5xxl,
+                    self.device,
+                )
+            )
+        cond = tuple(torch.cat(c) for c in zip(*conds))
+        neg_cond = tuple(torch.cat(c) for c in zip(*neg_conds))
+        guidance_scale = torch.tensor([params["guidance_scale"] for params in batch])
+
+        params = batch[0]
+        latents = sd3_inference.do_sample(
+            params["height"],
+            params["width"],
+            None,
+            [params["seed"] for params in batch],
+            cond,
+            neg_cond,
+            self.mmdit,
+            params["steps"],
+            guidance_scale,
+            self.sd3_dtype,
+            self.device,
+            params["sampler"],
+            self.args.shift,
+            self.args.sigma_spacing,
+            self.args.cfg_interval,
+        )
+        return sd3_inference.decode_images(self.vae, latents)
+
+    def generate(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        params = self.parse_request(request)
+        start_time = time.perf_counter()
+        with self.lock:
+            self.num_requests += 1
+            request_id = self.num_requests
+
+        image = self.scheduler.submit(self.batch_key(params), params).result()
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_path = os.path.join(
+            self.args.output_dir, f"{timestamp}_{request_id:06d}_{params['seed']}.png"
+        )
+        image.save(output_path, compress_level=self.args.png_compress_level)
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"Request {request_id}: saved {output_path} in {elapsed:.2f}s")
+
+        response = {
+            "id": request_id,
+            "path": output_path,
+            "seed": params["seed"],
+            "elapsed": elapsed,
+        }
+        if params["return_image"]:
+            with open(output_path, "rb") as f:
+                response["image"] = base64.b64encode(f.read()).decode("ascii")
+        return response
+
+
+def create_http_handler(server: SD3Server):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes, content_type: str, headers={}):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, obj: Dict[str, Any]):
+            self._send(status, json.dumps(obj).encode("utf-8"), "application/json")
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                # ?format=png returns the PNG itself instead of JSON
+                as_png = parse_qs(url.query).get("format", ["json"])[0] == "png"
+                if as_png:
+                    request["return_image"] = False
+                response = server.generate(request)
+            except (ValueError, TypeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                logger.exception("failed to generate")
+                self._send_json(500, {"error": str(e)})
+                return
+
+            if as_png:
+                with open(response["path"], "rb") as f:
+                    body = f.read()
+                headers = {
+                    "X-Image-Path": response["path"],
+                    "X-Seed": str(response["seed"]),
+                }
+                self._send(200, body, "image/png", headers)
+            else:
+                self._send_json(200, response)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def serve_http(server: SD3Server, host: str, port: int):
+    httpd = ThreadingHTTPServer((host, port), create_http_handler(server))
+    logger.info(f"Serving SD3 on http://{host}:{port} (POST /generate, GET /health)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def serve_stdin(server: SD3Server):
+    # one JSON request per line in, one JSON response per line out in the same order.
+    # lines are read ahead on another thread so that they can be batched
+    logger.info("Reading JSONL requests from stdin")
+    responses = queue.Queue()
+
+    def generate_line(line: str) -> Dict[str, Any]:
+        try:
+            return server.generate(json.loads(line))
+        except Exception as e:
+            logger.exception("failed to generate")
+            return {"error": str(e)}
+
+    def read_lines():
+        with ThreadPoolExecutor(max_workers=server.args.max_batch_size) as executor:
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    responses.put(executor.submit(generate_line, line))
+        responses.put(None)
+
+    threading.Thread(target=read_lines, daemon=True).start()
+    while True:
+        future = responses.get()
+        if future is None:
+            break
+        sys.stdout.write(json.dumps(future.result()) + "\n")
+        sys.stdout.flush()
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    # the model and sampling options of sd3_inference.py, not its batch, preview and writer options
+    parser = argparse.ArgumentParser()
+    sd3_inference.add_model_arguments(parser)
+    sd3_inference.add_sampling_arguments(parser)
+    parser.add_argument("--output_dir", type=str, default=".")
+    parser.add_argument(
+        "--png_compress_level",
+        type=int,
+        default=6,
+        help="PNG compression level 0-9, lower is faster and larger. default: 6",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="http",
+        choices=["http", "stdin"],
+        help="http server or JSONL request loop on stdin/stdout. default: http",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=4,
+        help="max number of requests generated in one batch. default: 4",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=50.0,
+        help="max time to wait for more requests to fill a batch, in milliseconds. default: 50",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    # python -m inferences.sd3_server --ckpt_path sd3_medium.safetensors --bf16 --port 8000
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    server = SD3Server(args, device)
+    if args.mode == "http":
+        serve_http(server, args.host, args.port)
+    else:
+        serve_stdin(server)
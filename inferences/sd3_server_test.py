@@ -0,0 +1,221 @@
+import base64
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from inferences import sd3_server
+from inferences.sd3_server import BatchScheduler
+
+
+class FakeClock:
+    # time moves only when the test sets it, so the tests do not depend on the speed of the machine
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def set(self, scheduler: BatchScheduler, time: float):
+        with scheduler.condition:
+            self.time = time
+            scheduler.condition.notify()
+
+
+def test_batch_scheduler_groups_by_key():
+    batches = []
+
+    def run_batch(batch):
+        batches.append([params["i"] for params in batch])
+        return [params["i"] * 10 for params in batch]
+
+    clock = FakeClock()
+    scheduler = BatchScheduler(run_batch, max_batch_size=3, max_wait=1.0, clock=clock)
+    futures = [
+        scheduler.submit((64, 64, 4) if i % 2 == 0 else (128, 64, 4), {"i": i})
+        for i in range(5)
+    ]
+    # the first batch is full, the second one waits for max_wait
+    assert futures[0].result(timeout=10) == 0
+    assert not futures[1].done()
+    clock.set(scheduler, 1.0)
+    results = [future.result(timeout=10) for future in futures]
+
+    assert results == [0, 10, 20, 30, 40]
+    assert batches == [[0, 2, 4], [1, 3]]
+
+
+def test_batch_scheduler_waits_from_arrival():
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(batch):
+        started.set()
+        release.wait(timeout=10)
+        return [None] * len(batch)
+
+    clock = FakeClock()
+    scheduler = BatchScheduler(run_batch, max_batch_size=2, max_wait=1.0, clock=clock)
+    first = scheduler.submit("a", {})
+    clock.set(scheduler, 1.0)
+    assert started.wait(timeout=10)
+
+    # arrives while the first batch runs, and has waited max_wait when it finishes
+    second = scheduler.submit("b", {})
+    clock.time = 2.0
+    release.set()
+    first.result(timeout=10)
+    second.result(timeout=10)
+
+
+def test_batch_scheduler_propagates_errors():
+    def run_batch(batch):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=2, max_wait=0.0)
+    future = scheduler.submit("key", {})
+    with pytest.raises(RuntimeError):
+        future.result(timeout=10)
+
+
+class StubServer(sd3_server.SD3Server):
+    # no models, a batch is a gray image per request. the prompt "fail" fails the batch
+    def load_models(self):
+        mmdit = SimpleNamespace(pos_embed_max_size=192, patch_size=2)
+        return None, mmdit, None, None, None, None
+
+    def generate_batch(self, batch):
+        if any(params["prompt"] == "fail" for params in batch):
+            raise RuntimeError("out of memory")
+        return [
+            Image.new("RGB", (params["width"], params["height"])) for params in batch
+        ]
+
+
+@pytest.fixture
+def server(tmp_path):
+    args = sd3_server.setup_parser().parse_args(
+        [
+            "--ckpt_path",
+            "unused",
+            "--output_dir",
+            str(tmp_path),
+            "--width",
+            "64",
+            "--height",
+            "32",
+        ]
+    )
+    return StubServer(args, "cpu")
+
+
+def test_setup_parser_rejects_unused_options():
+    parser = sd3_server.setup_parser()
+    args = parser.parse_args(["--ckpt_path", "unused", "--fuse_adaln", "--steps", "20"])
+    assert args.fuse_adaln and args.steps == 20
+    # batch, preview and writer options of sd3_inference.py are not used by the server
+    for option in ["--num_images", "--batch_size", "--preview_steps", "--image_format"]:
+        with pytest.raises(SystemExit):
+            parser.parse_args(["--ckpt_path", "unused", option, "2"])
+
+
+def test_parse_request(server):
+    params = server.parse_request({"prompt": "a dog", "seed": 3, "return_image": True})
+    assert params["prompt"] == "a dog" and params["seed"] == 3
+    assert (params["width"], params["height"]) == (64, 32)
+    assert params["return_image"] is True
+    assert server.parse_request({"width": 3072})["width"] == 3072
+
+    invalid_requests = [
+        {"width": 0},
+        {"height": -16},
+        {"width": 100},
+        {"width": 3088},  # beyond the positional embedding
+        {"steps": 0},
+        {"sampler": "unknown"},
+        {"return_image": "false"},
+    ]
+    for request in invalid_requests:
+        with pytest.raises(ValueError):
+            server.parse_request(request)
+
+
+@pytest.fixture
+def http_url(server):
+    httpd = ThreadingHTTPServer(
+        ("127.0.0.1", 0), sd3_server.create_http_handler(server)
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(url, request):
+    data = json.dumps(request).encode("utf-8")
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=10) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_http_handler(http_url):
+    status, _, body = post(f"{http_url}/generate", {"seed": 5, "return_image": True})
+    assert status == 200
+    response = json.loads(body)
+    assert response["seed"] == 5
+    image = Image.open(io.BytesIO(base64.b64decode(response["image"])))
+    assert image.size == (64, 32)
+
+    status, headers, body = post(f"{http_url}/generate?format=png", {"seed": 6})
+    assert status == 200
+    assert headers["Content-Type"] == "image/png" and headers["X-Seed"] == "6"
+    assert Image.open(io.BytesIO(body)).size == (64, 32)
+
+    # invalid requests are client errors, failed generations server errors
+    status, _, body = post(f"{http_url}/generate", {"width": 0})
+    assert status == 400 and "width" in json.loads(body)["error"]
+    status, _, body = post(f"{http_url}/generate", {"prompt": "fail"})
+    assert status == 500 and "out of memory" in json.loads(body)["error"]
+    status, _, _ = post(f"{http_url}/unknown", {})
+    assert status == 404
+
+    with urllib.request.urlopen(f"{http_url}/health", timeout=10) as response:
+        assert json.loads(response.read()) == {"status": "ok"}
+
+
+def test_serve_stdin_keeps_order(server, monkeypatch, capsys):
+    # the first request finishes after the second one, its response is still written first
+    second_done = threading.Event()
+    generate = server.generate
+
+    def delayed_generate(request):
+        if request["seed"] == 1:
+            assert second_done.wait(timeout=10)
+        response = generate(request)
+        if request["seed"] == 2:
+            second_done.set()
+        return response
+
+    monkeypatch.setattr(server, "generate", delayed_generate)
+    lines = [json.dumps({"seed": 1}), "", "not json", json.dumps({"seed": 2})]
+    monkeypatch.setattr("sys.stdin", io.StringIO("\n".join(lines) + "\n"))
+    sd3_server.serve_stdin(server)
+
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(responses) == 3
+    assert responses[0]["seed"] == 1
+    assert "error" in responses[1]
+    assert responses[2]["seed"] == 2
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -4,18 +4,25 @@
 # and some module/classes are contributed from KohakuBlueleaf. Thanks for the contribution!
 
 from ast import Tuple
+from collections import OrderedDict
+import contextlib
 from functools import partial
+import logging
 import math
 from types import SimpleNamespace
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, Iterator, List, Optional, Union
+import weakref
 import einops
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
 from torch.utils.checkpoint import checkpoint
 from transformers import CLIPTokenizer, T5TokenizerFast
 
+logger = logging.getLogger(__name__)
 
 memory_efficient_attention = None
 try:
@@ -252,10 +259,25 @@ def get_2d_sincos_pos_embed_torch(
     return emb
 
 
-def modulate(x, shift, scale):
+def modulate(x, shift, scale, inplace=False):
+    """
+    x * (1 + scale) + shift, shift may be None (scale_mod_only).
+    inplace: x is a temporary, overwrite it if autograd does not need it and the dtype does not change.
+    """
+    scale = scale.unsqueeze(1) + 1
+    if shift is not None:
+        shift = shift.unsqueeze(1)
+    if (
+        inplace
+        and not torch.is_grad_enabled()
+        and x.dtype == scale.dtype
+        and (shift is None or x.dtype == shift.dtype)
+    ):
+        x = x.mul_(scale)
+        return x if shift is None else x.add_(shift)
     if shift is None:
-        shift = torch.zeros_like(scale)
-    return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+        return x * scale
+    return torch.addcmul(shift, x, scale)
 
 
 def default(x, default_value):
@@ -347,7 +369,7 @@ class UnPatch(nn.Module):
             nn.Linear(hidden_size, 2 * hidden_size),
         )
 
-    def forward(self, x: torch.Tensor, cmod, H=None, W=None):
+    def forward(self, x: torch.Tensor, cmod, H=None, W=None, modulation=None):
         b, n, _ = x.shape
         p = self.patch_size
         c = self.c
@@ -359,8 +381,10 @@ class UnPatch(nn.Module):
             w = W // p if W else n // h
             assert h * w == n
 
-        shift, scale = self.adaLN_modulation(cmod).chunk(2, dim=-1)
-        x = modulate(self.norm_final(x), shift, scale)
+        if modulation is None:
+            modulation = self.adaLN_modulation(cmod)
+        shift, scale = modulation.chunk(2, dim=-1)
+        x = modulate(self.norm_final(x), shift, scale, inplace=True)
         x = self.linear(x)
 
         x = x.view(b, h, w, p, p, c)
@@ -379,6 +403,8 @@ class MLP(nn.Module):
         norm_layer=None,
         bias=True,
         use_conv=False,
+        dtype=None,
+        device=None,
     ):
         super().__init__()
         out_features = out_features or in_features
@@ -387,8 +413,12 @@ class MLP(nn.Module):
 
         layer = partial(nn.Conv1d, kernel_size=1) if use_conv else nn.Linear
 
-        self.fc1 = layer(in_features, hidden_features, bias=bias)
-        self.fc2 = layer(hidden_features, out_features, bias=bias)
+        self.fc1 = layer(
+            in_features, hidden_features, bias=bias, dtype=dtype, device=device
+        )
+        self.fc2 = layer(
+            hidden_features, out_features, bias=bias, dtype=dtype, device=device
+        )
         self.act = act_layer()
         self.norm = norm_layer(hidden_features) if norm_layer else nn.Identity()
 
@@ -536,72 +566,238 @@ class AttentionLinears(nn.Module):
         k = self.ln_k(k).reshape(q.shape[0], q.shape[1], -1)
         return (q, k, v)
 
+    def qkv_into(self, x: torch.Tensor, out: torch.Tensor):
+        """
+        Write self.qkv(x) into out, which may be a strided view of a larger buffer. Without autograd only.
+        """
+        weight = self.qkv.weight.t().expand(x.shape[0], -1, -1)
+        if self.qkv.bias is not None:
+            torch.baddbmm(self.qkv.bias, x, weight, out=out)
+        else:
+            torch.bmm(x, weight, out=out)
+
     def post_attention(self, x: torch.Tensor) -> torch.Tensor:
         assert not self.pre_only
         x = self.proj(x)
         return x
 
 
+# q, k, v: [B, L, D] -> layout of an attention backend, and the output back to [B, L, D]
 MEMORY_LAYOUTS = {
-    "torch": (
+    # batch, heads, length, head_dim
+    "bhld": (
         lambda x, head_dim: x.reshape(x.shape[0], x.shape[1], -1, head_dim).transpose(
             1, 2
         ),
         lambda x: x.transpose(1, 2).reshape(x.shape[0], x.shape[2], -1),
-        lambda x: (1, x, 1, 1),
     ),
-    "xformers": (
+    # batch, length, heads, head_dim
+    "blhd": (
         lambda x, head_dim: x.reshape(x.shape[0], x.shape[1], -1, head_dim),
         lambda x: x.reshape(x.shape[0], x.shape[1], -1),
-        lambda x: (1, 1, x, 1),
-    ),
-    "math": (
-        lambda x, head_dim: x.reshape(x.shape[0], x.shape[1], -1, head_dim).transpose(
-            1, 2
-        ),
-        lambda x: x.transpose(1, 2).reshape(x.shape[0], x.shape[2], -1),
-        lambda x: (1, x, 1, 1),
     ),
 }
-# ATTN_FUNCTION = {
-#     "torch": F.scaled_dot_product_attention,
-#     "xformers": memory_efficient_attention,
-# }
+
+
+class AttentionBackend:
+    """
+    An attention implementation. fn(q, k, v, mask, scale) takes q, k, v in the layout and returns the output in it.
+    mask is a bool mask (True to attend) or an additive float bias broadcastable to [B, H, Lq, Lk].
+    scale is None for 1 / sqrt(head_dim). A backend without support for a given mask or scale, or which is not
+    available, is replaced by its fallback.
+    """
+
+    def __init__(
+        self,
+        fn: Callable,
+        layout: str,
+        supports_mask: bool = True,
+        supports_scale: bool = True,
+        is_available: Callable[[], bool] = lambda: True,
+        fallback: Optional[str] = None,
+    ):
+        assert layout in MEMORY_LAYOUTS
+        self.fn = fn
+        self.layout = layout
+        self.supports_mask = supports_mask
+        self.supports_scale = supports_scale
+        self.is_available = is_available
+        self.fallback = fallback
+
+    def supports(self, mask, scale) -> bool:
+        return (
+            self.is_available()
+            and (mask is None or self.supports_mask)
+            and (scale is None or self.supports_scale)
+        )
+
+
+def sdpa_attention(q, k, v, mask, scale=None):
+    return F.scaled_dot_product_attention(q, k, v, mask, scale=scale)
 
 
 def vanilla_attention(q, k, v, mask, scale=None):
     if scale is None:
-        scale = math.sqrt(q.size(-1))
-    scores = torch.bmm(q, k.transpose(-1, -2)) / scale
+        scale = 1 / math.sqrt(q.size(-1))
+    scores = torch.matmul(q, k.transpose(-1, -2)) * scale
     if mask is not None:
-        mask = einops.rearrange(mask, "b ... -> b (...)")
-        max_neg_value = -torch.finfo(scores.dtype).max
-        mask = einops.repeat(mask, "b j -> (b h) j", h=q.size(-3))
-        scores = scores.masked_fill(~mask, max_neg_value)
+        if mask.dtype == torch.bool:
+            scores = scores.masked_fill(~mask, -torch.finfo(scores.dtype).max)
+        else:
+            scores = scores + mask
     p_attn = F.softmax(scores, dim=-1)
-    return torch.bmm(p_attn, v)
+    return torch.matmul(p_attn, v)
+
+
+ATTENTION_CHUNK_SIZE = 1024
+
+
+def set_attention_chunk_size(chunk_size: int):
+    """
+    Set the number of queries (and keys for tiled) per chunk of the chunked and tiled attention backends.
+    """
+    global ATTENTION_CHUNK_SIZE
+    assert chunk_size > 0
+    ATTENTION_CHUNK_SIZE = chunk_size
+
+
+def _slice_mask(mask, q_start, q_end, k_start=0, k_end=None):
+    # mask may be broadcast along the query or key dimension
+    if mask is None:
+        return None
+    if mask.ndim >= 2 and mask.shape[-2] > 1:
+        mask = mask[..., q_start:q_end, :]
+    if k_end is not None and mask.shape[-1] > 1:
+        mask = mask[..., k_start:k_end]
+    return mask
+
+
+def chunked_attention(q, k, v, mask, scale=None):
+    """
+    SDPA over chunks of ATTENTION_CHUNK_SIZE queries, the attention scores of a chunk only are kept in memory.
+    """
+    if q.shape[-2] <= ATTENTION_CHUNK_SIZE:
+        return sdpa_attention(q, k, v, mask, scale)
+    out = torch.empty_like(q)
+    for start in range(0, q.shape[-2], ATTENTION_CHUNK_SIZE):
+        end = start + ATTENTION_CHUNK_SIZE
+        out[..., start:end, :] = sdpa_attention(
+            q[..., start:end, :], k, v, _slice_mask(mask, start, end), scale
+        )
+    return out
+
+
+def tiled_attention(q, k, v, mask, scale=None):
+    """
+    Attention with an online softmax (as FlashAttention) in pure torch. Queries are processed in chunks of
+    ATTENTION_CHUNK_SIZE, and keys and values in tiles of the same size with a running max and sum of the softmax,
+    so the memory for the scores is O(chunk_size^2) per head instead of O(Lq * Lk). Accumulates in float32.
+    """
+    if scale is None:
+        scale = 1 / math.sqrt(q.size(-1))
+    chunk_size = ATTENTION_CHUNK_SIZE
+    q_len, k_len = q.shape[-2], k.shape[-2]
+    out = torch.empty(q.shape[:-1] + v.shape[-1:], dtype=q.dtype, device=q.device)
+    for q_start in range(0, q_len, chunk_size):
+        q_end = q_start + chunk_size
+        q_chunk = q[..., q_start:q_end, :] * scale
+        stats_shape = q_chunk.shape[:-1] + (1,)
+        row_max = torch.full(stats_shape, float("-inf"), device=q.device)
+        row_sum = torch.zeros(stats_shape, device=q.device)
+        acc = torch.zeros(q_chunk.shape[:-1] + v.shape[-1:], device=q.device)
+        for k_start in range(0, k_len, chunk_size):
+            k_end = k_start + chunk_size
+            scores = torch.matmul(
+                q_chunk, k[..., k_start:k_end, :].transpose(-1, -2)
+            ).float()
+            tile_mask = _slice_mask(mask, q_start, q_end, k_start, k_end)
+            if tile_mask is not None:
+                if tile_mask.dtype == torch.bool:
+                    scores = scores.masked_fill(~tile_mask, float("-inf"))
+                else:
+                    scores = scores + tile_mask
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows without any key so far stay at -inf, subtract 0 instead of -inf to avoid nan
+            safe_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+            probs = torch.exp(scores - safe_max)
+            correction = torch.exp(row_max - safe_max)
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            acc = (
+                acc * correction
+                + torch.matmul(probs.to(v.dtype), v[..., k_start:k_end, :]).float()
+            )
+            row_max = new_max
+        out[..., q_start:q_end, :] = (acc / row_sum).to(out.dtype)
+    return out
+
+
+def xformers_attention(q, k, v, mask, scale=None):
+    if mask is not None:
+        if mask.dtype == torch.bool:
+            mask = torch.zeros(mask.shape, dtype=q.dtype, device=q.device).masked_fill(
+                ~mask, float("-inf")
+            )
+        # the kernels read the bias with its own strides, an expanded (zero stride) bias is not supported
+        mask = (
+            mask.to(q.dtype)
+            .expand(q.shape[0], q.shape[2], q.shape[1], k.shape[1])
+            .contiguous()
+        )
+    return memory_efficient_attention(q, k, v, mask, scale=scale)
+
+
+ATTENTION_BACKENDS: Dict[str, AttentionBackend] = {
+    "torch": AttentionBackend(sdpa_attention, "bhld"),
+    "chunked": AttentionBackend(chunked_attention, "bhld"),
+    "tiled": AttentionBackend(tiled_attention, "bhld"),
+    "xformers": AttentionBackend(
+        xformers_attention,
+        "blhd",
+        is_available=lambda: memory_efficient_attention is not None,
+        fallback="torch",
+    ),
+    "math": AttentionBackend(vanilla_attention, "bhld"),
+}
+
+
+def register_attention_backend(name: str, backend: AttentionBackend):
+    ATTENTION_BACKENDS[name] = backend
+
+
+_warned_fallbacks = set()
+
+
+def resolve_attention_backend(mode: str, mask=None, scale=None) -> AttentionBackend:
+    """
+    Returns the backend for mode, or the first fallback of it that is available and supports mask and scale.
+    """
+    if mode not in ATTENTION_BACKENDS:
+        raise ValueError(f"unknown attention mode: {mode}")
+    name = mode
+    backend = ATTENTION_BACKENDS[name]
+    while not backend.supports(mask, scale):
+        if backend.fallback is None:
+            raise RuntimeError(f"no attention backend is usable for mode {mode}")
+        name = backend.fallback
+        backend = ATTENTION_BACKENDS[name]
+    if name != mode and (mode, name) not in _warned_fallbacks:
+        _warned_fallbacks.add((mode, name))
+        logger.warning(f"attention mode {mode} is not usable, falling back to {name}")
+    return backend
 
 
 def attention(q, k, v, head_dim, mask=None, scale=None, mode="xformers"):
     """
     q, k, v: [B, L, D]
+    mode: name of the backend in ATTENTION_BACKENDS
     """
-    pre_attn_layout = MEMORY_LAYOUTS[mode][0]
-    post_attn_layout = MEMORY_LAYOUTS[mode][1]
+    backend = resolve_attention_backend(mode, mask, scale)
+    pre_attn_layout, post_attn_layout = MEMORY_LAYOUTS[backend.layout]
     q = pre_attn_layout(q, head_dim)
     k = pre_attn_layout(k, head_dim)
     v = pre_attn_layout(v, head_dim)
 
-    # scores = ATTN_FUNCTION[mode](q, k.to(q), v.to(q), mask, scale=scale)
-    if mode == "torch":
-        assert scale is None
-        scores = F.scaled_dot_product_attention(
-            q, k.to(q), v.to(q), mask
-        )  # , scale=scale)
-    elif mode == "xformers":
-        scores = memory_efficient_attention(q, k.to(q), v.to(q), mask, scale=scale)
-    else:
-        scores = vanilla_attention(q, k.to(q), v.to(q), mask, scale=scale)
+    scores = backend.fn(q, k.to(q), v.to(q), mask, scale)
 
     scores = post_attn_layout(scores)
     return scores
@@ -610,7 +806,7 @@ def attention(q, k, v, head_dim, mask=None, scale=None, mode="xformers"):
 class SelfAttention(AttentionLinears):
     def __init__(self, dim, num_heads=8, mode="xformers"):
         super().__init__(dim, num_heads, qkv_bias=True, pre_only=False)
-        assert mode in MEMORY_LAYOUTS
+        assert mode in ATTENTION_BACKENDS
         self.head_dim = dim // num_heads
         self.attn_mode = mode
 
@@ -677,7 +873,7 @@ class SingleDiTBlock(nn.Module):
         **block_kwargs,
     ):
         super().__init__()
-        assert attn_mode in MEMORY_LAYOUTS
+        assert attn_mode in ATTENTION_BACKENDS
         self.attn_mode = attn_mode
         if not rmsnorm:
             self.norm1 = nn.LayerNorm(hidden_size, elementwise_affine=False, eps=1e-6)
@@ -721,7 +917,13 @@ class SingleDiTBlock(nn.Module):
         )
         self.pre_only = pre_only
 
-    def pre_attention(self, x: torch.Tensor, c: torch.Tensor) -> torch.Tensor:
+    def pre_attention(
+        self, x: torch.Tensor, c: torch.Tensor, modulation=None, qkv_out=None
+    ) -> torch.Tensor:
+        # modulation: precomputed self.adaLN_modulation(c), see MMDiT.fuse_adaln_modulation
+        # qkv_out: buffer to write the qkv projection into, q, k and v are not returned then
+        if modulation is None:
+            modulation = self.adaLN_modulation(c)
         if not self.pre_only:
             if not self.scale_mod_only:
                 (
@@ -731,7 +933,7 @@ class SingleDiTBlock(nn.Module):
                     shift_mlp,
                     scale_mlp,
                     gate_mlp,
-                ) = self.adaLN_modulation(c).chunk(6, dim=-1)
+                ) = modulation.chunk(6, dim=-1)
             else:
                 shift_msa = None
                 shift_mlp = None
@@ -740,10 +942,10 @@ class SingleDiTBlock(nn.Module):
                     gate_msa,
                     scale_mlp,
                     gate_mlp,
-                ) = self.adaLN_modulation(
-                    c
-                ).chunk(4, dim=-1)
-            qkv = self.attn.pre_attention(modulate(self.norm1(x), shift_msa, scale_msa))
+                ) = modulation.chunk(4, dim=-1)
+            qkv = self._pre_attention_qkv(
+                modulate(self.norm1(x), shift_msa, scale_msa, inplace=True), qkv_out
+            )
             return qkv, (
                 x,
                 gate_msa,
@@ -756,24 +958,39 @@ class SingleDiTBlock(nn.Module):
                 (
                     shift_msa,
                     scale_msa,
-                ) = self.adaLN_modulation(
-                    c
-                ).chunk(2, dim=-1)
+                ) = modulation.chunk(2, dim=-1)
             else:
                 shift_msa = None
-                scale_msa = self.adaLN_modulation(c)
-            qkv = self.attn.pre_attention(modulate(self.norm1(x), shift_msa, scale_msa))
+                scale_msa = modulation
+            qkv = self._pre_attention_qkv(
+                modulate(self.norm1(x), shift_msa, scale_msa, inplace=True), qkv_out
+            )
             return qkv, None
 
+    def _pre_attention_qkv(self, x: torch.Tensor, qkv_out: Optional[torch.Tensor]):
+        if qkv_out is None:
+            return self.attn.pre_attention(x)
+        self.attn.qkv_into(x, qkv_out)
+        return None
+
     def post_attention(self, attn, x, gate_msa, shift_mlp, scale_mlp, gate_mlp):
         assert not self.pre_only
         x = x + gate_msa.unsqueeze(1) * self.attn.post_attention(attn)
         x = x + gate_mlp.unsqueeze(1) * self.mlp(
-            modulate(self.norm2(x), shift_mlp, scale_mlp)
+            modulate(self.norm2(x), shift_mlp, scale_mlp, inplace=True)
         )
         return x
 
 
+def is_autocast_enabled() -> bool:
+    if torch.is_autocast_enabled():  # CUDA
+        return True
+    try:
+        return torch.is_autocast_enabled("cpu")
+    except TypeError:  # torch < 2.4
+        return torch.is_autocast_cpu_enabled()
+
+
 # JointBlock + block_mixing in mmdit.py
 class MMDiTBlock(nn.Module):
     def __init__(self, *args, **kwargs):
@@ -788,15 +1005,44 @@ class MMDiTBlock(nn.Module):
     def enable_gradient_checkpointing(self):
         self.gradient_checkpointing = True
 
-    def _forward(self, context, x, c):
-        ctx_qkv, ctx_intermediate = self.context_block.pre_attention(context, c)
-        x_qkv, x_intermediate = self.x_block.pre_attention(x, c)
-
-        ctx_len = ctx_qkv[0].size(1)
+    def _can_use_joint_qkv(self, context, x) -> bool:
+        # the projections are written to a joint buffer by out= matmuls, which autograd and autocast do not support.
+        # q and k must be used as projected
+        if torch.is_grad_enabled() or is_autocast_enabled():
+            return False
+        for block in (self.context_block, self.x_block):
+            if not isinstance(block.attn.ln_q, nn.Identity) or not isinstance(
+                block.attn.ln_k, nn.Identity
+            ):
+                return False
+            if block.attn.qkv.weight.dtype != x.dtype:
+                return False
+        return context.dtype == x.dtype
+
+    def _forward(self, context, x, c, modulation=None):
+        # modulation: (context modulation, x modulation) precomputed by MMDiT.fuse_adaln_modulation
+        ctx_modulation, x_modulation = modulation or (None, None)
+        ctx_len = context.size(1)
+
+        if self._can_use_joint_qkv(context, x):
+            # both streams write their projections into one buffer, no concatenation of q, k and v
+            qkv = x.new_empty(x.shape[0], ctx_len + x.shape[1], 3 * x.shape[2])
+            _, ctx_intermediate = self.context_block.pre_attention(
+                context, c, ctx_modulation, qkv[:, :ctx_len]
+            )
+            _, x_intermediate = self.x_block.pre_attention(
+                x, c, x_modulation, qkv[:, ctx_len:]
+            )
+            q, k, v = qkv.chunk(3, dim=-1)
+        else:
+            ctx_qkv, ctx_intermediate = self.context_block.pre_attention(
+                context, c, ctx_modulation
+            )
+            x_qkv, x_intermediate = self.x_block.pre_attention(x, c, x_modulation)
 
-        q = torch.concat((ctx_qkv[0], x_qkv[0]), dim=1)
-        k = torch.concat((ctx_qkv[1], x_qkv[1]), dim=1)
-        v = torch.concat((ctx_qkv[2], x_qkv[2]), dim=1)
+            q = torch.concat((ctx_qkv[0], x_qkv[0]), dim=1)
+            k = torch.concat((ctx_qkv[1], x_qkv[1]), dim=1)
+            v = torch.concat((ctx_qkv[2], x_qkv[2]), dim=1)
 
         attn = attention(q, k, v, head_dim=self.head_dim, mode=self.mode)
         ctx_attn_out = attn[:, :ctx_len]
@@ -816,6 +1062,77 @@ class MMDiTBlock(nn.Module):
             return self._forward(*args, **kwargs)
 
 
+POS_EMBED_CACHE_SIZE = 16
+
+
+class MMDiTFeatureCache:
+    """
+    Reuses the residuals of MMDiT blocks from an earlier forward (denoising step) instead of running the blocks.
+    Consecutive steps have nearly identical block inputs, so the residual (output - input) of a block changes little.
+    A block in [start_block, end_block) is skipped when:
+    - interval is None: the mean absolute change of its image token input, relative to the input its cached residual
+      was computed from, is below threshold
+    - interval is set: the forward is not a multiple of interval since reset (fixed schedule, threshold is ignored)
+    Call reset() before each generation. skipped_blocks has the number of skipped blocks per forward.
+    Only used in eval mode. Inputs and residuals of cached blocks are kept in memory.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.05,
+        interval: Optional[int] = None,
+        start_block: int = 1,
+        end_block: Optional[int] = None,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.start_block = start_block
+        self.end_block = end_block
+        self.reset()
+
+    def reset(self):
+        self.inputs: Dict[int, torch.Tensor] = {}  # block index -> x input
+        self.residuals = {}  # block index -> (context residual or None, x residual)
+        self.num_forwards = 0
+        self.skipped_blocks: List[int] = []
+
+    def is_cached_block(self, index: int, depth: int) -> bool:
+        # the last block is pre_only and has no context output by default
+        end_block = depth - 1 if self.end_block is None else self.end_block
+        return self.start_block <= index < end_block
+
+    def can_reuse(self, index: int, x: torch.Tensor) -> bool:
+        prev_x = self.inputs.get(index)
+        if prev_x is None or prev_x.shape != x.shape:
+            return False
+        if self.interval is not None:
+            return self.num_forwards % self.interval != 0
+        change = (x - prev_x).abs().mean() / prev_x.abs().mean().clamp(min=1e-6)
+        return change.item() < self.threshold
+
+    def run_block(self, index: int, block: nn.Module, context, x, c, modulation=None):
+        if self.can_reuse(index, x):
+            context_residual, x_residual = self.residuals[index]
+            self.skipped_blocks[-1] += 1
+            if context_residual is not None:
+                context = context + context_residual
+            return context, x + x_residual
+
+        new_context, new_x = block(context, x, c, modulation)
+        self.inputs[index] = x
+        self.residuals[index] = (
+            new_context - context if new_context is not None else None,
+            new_x - x,
+        )
+        return new_context, new_x
+
+    def begin_forward(self):
+        self.skipped_blocks.append(0)
+
+    def end_forward(self):
+        self.num_forwards += 1
+
+
 class MMDiT(nn.Module):
     """
     Diffusion model with a Transformer backbone.
@@ -933,6 +1250,15 @@ class MMDiT(nn.Module):
         self.final_layer = UnPatch(self.hidden_size, patch_size, self.out_channels)
         # self.initialize_weights()
 
+        self.feature_cache: Optional[MMDiTFeatureCache] = None
+
+        # (h, w, dtype, device) -> cropped pos_embed, least recently used first
+        self.pos_embed_cache: OrderedDict = OrderedDict()
+        self.pos_embed_cache_version = None
+
+        # concatenated adaLN weights of all blocks, see fuse_adaln_modulation
+        self.fused_adaln = None
+
     @property
     def model_type(self):
         return "m"  # only support medium
@@ -947,6 +1273,12 @@ class MMDiT(nn.Module):
         for block in self.joint_blocks:
             block.disable_gradient_checkpointing()
 
+    def enable_feature_cache(self, feature_cache: MMDiTFeatureCache):
+        self.feature_cache = feature_cache
+
+    def disable_feature_cache(self):
+        self.feature_cache = None
+
     def initialize_weights(self):
         # TODO: Init context_embedder?
         # Initialize transformer layers:
@@ -1017,35 +1349,124 @@ class MMDiT(nn.Module):
         )
         return spatial_pos_embed
 
+    def _adaln_linears(self) -> List[nn.Linear]:
+        linears = []
+        for block in self.joint_blocks:
+            linears.append(block.context_block.adaLN_modulation[-1])
+            linears.append(block.x_block.adaLN_modulation[-1])
+        linears.append(self.final_layer.adaLN_modulation[-1])
+        return linears
+
+    def fuse_adaln_modulation(self):
+        """
+        Concatenate the adaLN modulation weights of all blocks and the final layer, so that every shift, scale and
+        gate is computed by one matmul per forward. All of them take the same conditioning c.
+        The Linear weights become views of the concatenated weight, so no memory is added and the state dict is
+        unchanged. Only used without autograd; if the weights are moved afterwards (eg. by .to()), the unfused path
+        is used again until this is called again.
+        """
+        linears = self._adaln_linears()
+        weight = torch.cat([linear.weight.data for linear in linears])
+        bias = torch.cat([linear.bias.data for linear in linears])
+        split_sizes = []
+        offset = 0
+        for linear in linears:
+            size = linear.weight.shape[0]
+            linear.weight.data = weight[offset : offset + size]
+            linear.bias.data = bias[offset : offset + size]
+            split_sizes.append(size)
+            offset += size
+        data_ptrs = [linear.weight.data_ptr() for linear in linears]
+        self.fused_adaln = (weight, bias, split_sizes, data_ptrs)
+
+    def unfuse_adaln_modulation(self):
+        self.fused_adaln = None
+
+    def fused_adaln_modulation(self, c: torch.Tensor) -> Optional[List[torch.Tensor]]:
+        """
+        Returns adaLN_modulation(c) of each linear in _adaln_linears order, or None if the fused path is not usable.
+        """
+        if self.fused_adaln is None or torch.is_grad_enabled():
+            return None
+        weight, bias, split_sizes, data_ptrs = self.fused_adaln
+        linears = self._adaln_linears()
+        if [linear.weight.data_ptr() for linear in linears] != data_ptrs:
+            # weights are moved or replaced
+            self.fused_adaln = None
+            return None
+        modulation = F.linear(F.silu(c), weight, bias)
+        return modulation.split(split_sizes, dim=-1)
+
+    def get_pos_embed(self, h, w, dtype, device):
+        """
+        cropped_pos_embed cast to dtype and device, cached per size in a small LRU cache.
+        The cache is cleared when pos_embed is replaced or modified in place (eg. by load_state_dict or .to()).
+        """
+        if self.pos_embed is not None:
+            version = (self.pos_embed.data_ptr(), self.pos_embed._version)
+        else:
+            version = None
+        if version != self.pos_embed_cache_version:
+            self.pos_embed_cache.clear()
+            self.pos_embed_cache_version = version
+
+        key = (h, w, dtype, torch.device(device))
+        pos_embed = self.pos_embed_cache.get(key)
+        if pos_embed is not None:
+            self.pos_embed_cache.move_to_end(key)
+            return pos_embed
+
+        pos_embed = self.cropped_pos_embed(h, w, device=device)
+        pos_embed = pos_embed.to(dtype=dtype, device=device).contiguous()
+        self.pos_embed_cache[key] = pos_embed
+        if len(self.pos_embed_cache) > POS_EMBED_CACHE_SIZE:
+            self.pos_embed_cache.popitem(last=False)
+        return pos_embed
+
+    def prepare_conditioning(
+        self, y: Optional[torch.Tensor] = None, context: Optional[torch.Tensor] = None
+    ):
+        """
+        Embed y and context, which are the same at every denoising step. Pass the result to forward as
+        prepared_conditioning to skip the embedders. The results are batch first and can be sliced along the batch.
+        Returns (embedded y or None, embedded context or None).
+        """
+        if y is not None and self.y_embedder is not None:
+            y = self.y_embedder(y)  # (N, D)
+        else:
+            y = None
+
+        if self.context_processor is not None:
+            context = self.context_processor(context)
+        if context is not None:
+            context = self.context_embedder(context)
+        return y, context
+
     def forward(
         self,
         x: torch.Tensor,
         t: torch.Tensor,
         y: Optional[torch.Tensor] = None,
         context: Optional[torch.Tensor] = None,
+        prepared_conditioning: Optional[tuple] = None,
     ) -> torch.Tensor:
         """
         Forward pass of DiT.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         y: (N, D) tensor of class labels
+        prepared_conditioning: result of prepare_conditioning, used instead of y and context
         """
-
-        if self.context_processor is not None:
-            context = self.context_processor(context)
+        if prepared_conditioning is None:
+            prepared_conditioning = self.prepare_conditioning(y, context)
+        y, context = prepared_conditioning
 
         B, C, H, W = x.shape
-        x = self.x_embedder(x) + self.cropped_pos_embed(H, W, device=x.device).to(
-            dtype=x.dtype
-        )
+        x = self.x_embedder(x) + self.get_pos_embed(H, W, x.dtype, x.device)
         c = self.t_embedder(t, dtype=x.dtype)  # (N, D)
-        if y is not None and self.y_embedder is not None:
-            y = self.y_embedder(y)  # (N, D)
+        if y is not None:
             c = c + y  # (N, D)
 
-        if context is not None:
-            context = self.context_embedder(context)
-
         if self.register_length > 0:
             context = torch.cat(
                 (
@@ -1055,9 +1476,31 @@ class MMDiT(nn.Module):
                 1,
             )
 
-        for block in self.joint_blocks:
-            context, x = block(context, x, c)
-        x = self.final_layer(x, c, H, W)  # Our final layer combined UnPatchify
+        depth = len(self.joint_blocks)
+        modulations = self.fused_adaln_modulation(c)
+        if modulations is not None:
+            block_modulations = [modulations[2 * i : 2 * i + 2] for i in range(depth)]
+            final_modulation = modulations[-1]
+        else:
+            block_modulations = [None] * depth
+            final_modulation = None
+
+        feature_cache = self.feature_cache if not self.training else None
+        if feature_cache is None:
+            for block, modulation in zip(self.joint_blocks, block_modulations):
+                context, x = block(context, x, c, modulation)
+        else:
+            feature_cache.begin_forward()
+            for i, block in enumerate(self.joint_blocks):
+                if feature_cache.is_cached_block(i, depth):
+                    context, x = feature_cache.run_block(
+                        i, block, context, x, c, block_modulations[i]
+                    )
+                else:
+                    context, x = block(context, x, c, block_modulations[i])
+            feature_cache.end_forward()
+        # Our final layer combined UnPatchify
+        x = self.final_layer(x, c, H, W, final_modulation)
         return x[:, :, :H, :W]
 
 
@@ -1090,8 +1533,22 @@ VAE_SCALE_FACTOR = 1.5305
 VAE_SHIFT_FACTOR = 0.0609
 
 
+class GroupNorm32(torch.nn.GroupNorm):
+    """
+    GroupNorm computed in fp32 whatever the weight dtype and autocast, the output has the input dtype.
+    The statistics of the VAE activations overflow or lose precision in fp16 and bf16.
+    """
+
+    def forward(self, x):
+        with torch.autocast(x.device.type, enabled=False):
+            weight = self.weight.float() if self.weight is not None else None
+            bias = self.bias.float() if self.bias is not None else None
+            out = F.group_norm(x.float(), self.num_groups, weight, bias, self.eps)
+        return out.to(x.dtype)
+
+
 def Normalize(in_channels, num_groups=32, dtype=torch.float32, device=None):
-    return torch.nn.GroupNorm(
+    return GroupNorm32(
         num_groups=num_groups,
         num_channels=in_channels,
         eps=1e-6,
@@ -1197,8 +1654,31 @@ class AttnBlock(torch.nn.Module):
             dtype=dtype,
             device=device,
         )
+        # set by fuse_qkv, not saved
+        self.register_buffer("qkv_weight", None, persistent=False)
+        self.register_buffer("qkv_bias", None, persistent=False)
+
+    def fuse_qkv(self):
+        """
+        Compute q, k and v in one matmul over the tokens, the 1x1 convs are matmuls. The tokens are a view of a
+        channels_last activation, so no layout copies are made. The fused weight is a copy for inference, call this
+        again after changing the weights.
+        """
+        # plain copies: buffers holding an autograd graph to the weights would break backward after the first one
+        with torch.no_grad():
+            self.qkv_weight = torch.cat(
+                [self.q.weight, self.k.weight, self.v.weight]
+            ).flatten(1)
+            self.qkv_bias = torch.cat([self.q.bias, self.k.bias, self.v.bias])
+
+    def unfuse_qkv(self):
+        self.qkv_weight = None
+        self.qkv_bias = None
 
     def forward(self, x):
+        if self.qkv_weight is not None:
+            return self._fused_forward(x)
+
         hidden = self.norm(x)
         q = self.q(hidden)
         k = self.k(hidden)
@@ -1215,6 +1695,17 @@ class AttnBlock(torch.nn.Module):
         hidden = self.proj_out(hidden)
         return x + hidden
 
+    def _fused_forward(self, x):
+        hidden = self.norm(x)
+        b, c, h, w = hidden.shape
+        tokens = hidden.permute(0, 2, 3, 1).reshape(b, 1, h * w, c)
+        q, k, v = F.linear(tokens, self.qkv_weight, self.qkv_bias).chunk(3, dim=-1)
+        hidden = F.scaled_dot_product_attention(q, k, v)
+        hidden = F.linear(hidden, self.proj_out.weight.flatten(1), self.proj_out.bias)
+        # back to NCHW with channels_last strides
+        hidden = hidden.reshape(b, h, w, c).permute(0, 3, 1, 2)
+        return x + hidden
+
 
 class Downsample(torch.nn.Module):
     def __init__(self, in_channels, dtype=torch.float32, device=None):
@@ -1325,17 +1816,22 @@ class VAEEncoder(torch.nn.Module):
         )
         self.swish = torch.nn.SiLU(inplace=True)
 
-    def forward(self, x):
+    def forward(self, x, slice_size: Optional[int] = None):
+        """
+        Returns the moments (mean and logvar) of the latent. Only the current activation is kept alive, the encoder has
+        no skip connections. With slice_size, a larger batch is encoded in slices of slice_size images.
+        """
+        if slice_size is not None and x.shape[0] > slice_size:
+            return torch.cat([self(x_slice) for x_slice in x.split(slice_size)], dim=0)
+
         # downsampling
-        hs = [self.conv_in(x)]
+        h = self.conv_in(x)
         for i_level in range(self.num_resolutions):
             for i_block in range(self.num_res_blocks):
-                h = self.down[i_level].block[i_block](hs[-1])
-                hs.append(h)
+                h = self.down[i_level].block[i_block](h)
             if i_level != self.num_resolutions - 1:
-                hs.append(self.down[i_level].downsample(hs[-1]))
+                h = self.down[i_level].downsample(h)
         # middle
-        h = hs[-1]
         h = self.mid.block_1(h)
         h = self.mid.attn_1(h)
         h = self.mid.block_2(h)
@@ -1436,11 +1932,135 @@ class VAEDecoder(torch.nn.Module):
         return hidden
 
 
+def _tile_starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def _blend_weights(length: int, ramp_length: int) -> torch.Tensor:
+    # rises linearly over ramp_length at both ends and is never zero, so overlapping tiles fade into each other
+    weights = torch.ones(length)
+    ramp_length = min(ramp_length, length // 2)
+    if ramp_length > 0:
+        ramp = torch.arange(1, ramp_length + 1) / (ramp_length + 1)
+        weights[:ramp_length] = ramp
+        weights[-ramp_length:] = ramp.flip(0)
+    return weights
+
+
+def tiled_forward(
+    fn: Callable[[torch.Tensor], torch.Tensor],
+    x: torch.Tensor,
+    tile_size: int,
+    overlap: int,
+) -> torch.Tensor:
+    """
+    Apply fn to overlapping tiles of x (N, C, H, W) of tile_size and blend the outputs linearly over the overlap.
+    fn may change the spatial size by a constant factor (eg. the VAE decoder by 8). The tiles are processed one by
+    one, so the peak memory of fn is that of a tile.
+    """
+    assert 0 <= overlap < tile_size
+    height, width = x.shape[-2:]
+    out = None
+    for top in _tile_starts(height, tile_size, overlap):
+        for left in _tile_starts(width, tile_size, overlap):
+            tile = x[..., top : top + tile_size, left : left + tile_size]
+            tile_out = fn(tile)
+            if out is None:
+                scale = tile_out.shape[-1] / tile.shape[-1]
+                out = torch.zeros(
+                    *tile_out.shape[:-2],
+                    round(height * scale),
+                    round(width * scale),
+                    dtype=torch.float32,
+                    device=tile_out.device,
+                )
+                weight_sum = torch.zeros(out.shape[-2:], device=tile_out.device)
+                ramp_length = round(overlap * scale)
+            out_h, out_w = tile_out.shape[-2:]
+            weights = torch.outer(
+                _blend_weights(out_h, ramp_length), _blend_weights(out_w, ramp_length)
+            ).to(tile_out.device)
+            out_top, out_left = round(top * scale), round(left * scale)
+            out[..., out_top : out_top + out_h, out_left : out_left + out_w] += (
+                tile_out.float() * weights
+            )
+            weight_sum[
+                out_top : out_top + out_h, out_left : out_left + out_w
+            ] += weights
+            del tile_out
+    return (out / weight_sum).to(x.dtype if x.is_floating_point() else out.dtype)
+
+
+class MemoryCounter(TorchDispatchMode):
+    """
+    Counts the bytes of the tensors created by ops in this mode, on any device: allocated_bytes in total and
+    peak_bytes of those alive at the same time. Views and in-place ops do not allocate, tensors created before
+    entering the mode (inputs and parameters) are not counted. Unlike the CUDA memory stats, it does not reset any
+    device-wide state, so it can run inside other measurements.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.allocated_bytes = 0
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+    def _free(self, nbytes: int):
+        self.live_bytes -= nbytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if not func.is_view and not func._schema.is_mutable:
+            for tensor in tree_flatten(out)[0]:
+                if isinstance(tensor, torch.Tensor):
+                    self.allocated_bytes += tensor.nbytes
+                    self.live_bytes += tensor.nbytes
+                    weakref.finalize(tensor, self._free, tensor.nbytes)
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        return out
+
+
+def measure_peak_memory(fn: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor):
+    """
+    Returns (fn(x), peak bytes of the tensors allocated by fn), see MemoryCounter.
+    """
+    counter = MemoryCounter()
+    with counter:
+        out = fn(x)
+    return out, counter.peak_bytes
+
+
+# VAE precision -> (autocast dtype, device types where autocast is used). other device types run in the weight dtype
+VAE_PRECISIONS = {
+    "fp32": (None, ()),
+    "fp16": (torch.float16, ("cuda",)),
+    "bf16": (torch.bfloat16, ("cuda", "cpu")),
+}
+
+
 class SDVAE(torch.nn.Module):
-    def __init__(self, dtype=torch.float32, device=None):
+    def __init__(self, dtype=torch.float32, device=None, precision: str = "fp16"):
+        """
+        precision: autocast policy of encode and decode, see VAE_PRECISIONS. GroupNorm is always computed in fp32.
+        The default fp16 is autocast on CUDA only.
+        """
         super().__init__()
         self.encoder = VAEEncoder(dtype=dtype, device=device)
         self.decoder = VAEDecoder(dtype=dtype, device=device)
+        self.set_precision(precision)
+        self.tile_size = None  # in latent pixels, None to disable tiling
+        self.tile_overlap = 16
+        # see _footprint_key -> bytes per image
+        self.memory_footprints = {}
+        self.channels_last = False
+        # compiled forward of the encoder and decoder, set by optimize_for_inference
+        self.compiled_encoder = None
+        self.compiled_decoder = None
 
     @property
     def device(self):
@@ -1450,17 +2070,169 @@ class SDVAE(torch.nn.Module):
     def dtype(self):
         return next(self.parameters()).dtype
 
-    @torch.autocast("cuda", dtype=torch.float16)
+    def set_precision(self, precision: str):
+        if precision not in VAE_PRECISIONS:
+            raise ValueError(
+                f"unknown VAE precision: {precision}, available: {list(VAE_PRECISIONS.keys())}"
+            )
+        self.precision = precision
+
+    def autocast(self):
+        autocast_dtype, device_types = VAE_PRECISIONS[self.precision]
+        device_type = self.device.type
+        if autocast_dtype is None or device_type not in device_types:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type, dtype=autocast_dtype)
+
+    def optimize_for_inference(
+        self, channels_last: bool = True, fuse_qkv: bool = True, compile: bool = False
+    ):
+        """
+        Opt-in inference optimizations, mainly for CPU where oneDNN convolutions are faster in channels_last.
+        channels_last: convert the conv weights and the inputs of encode and decode to channels_last.
+        fuse_qkv: compute the attention q, k and v in one matmul, see AttnBlock.fuse_qkv.
+        compile: run the encoder and decoder through torch.compile, which also fuses GroupNorm and SiLU. The first
+        call per input shape is slow.
+        """
+        self.channels_last = channels_last
+        self.to(
+            memory_format=(
+                torch.channels_last if channels_last else torch.contiguous_format
+            )
+        )
+        for module in self.modules():
+            if isinstance(module, AttnBlock):
+                if fuse_qkv:
+                    module.fuse_qkv()
+                else:
+                    module.unfuse_qkv()
+        if compile:
+            self.compiled_encoder = torch.compile(self.encoder.forward)
+            self.compiled_decoder = torch.compile(self.decoder.forward)
+        else:
+            self.compiled_encoder = None
+            self.compiled_decoder = None
+
+    def _run(self, module: torch.nn.Module, compiled, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return (compiled or module)(x)
+
+    def _run_encoder(self, image: torch.Tensor) -> torch.Tensor:
+        return self._run(self.encoder, self.compiled_encoder, image)
+
+    def _run_decoder(self, latent: torch.Tensor) -> torch.Tensor:
+        return self._run(self.decoder, self.compiled_decoder, latent)
+
+    def enable_tiling(self, tile_size: int = 64, overlap: int = 16):
+        """
+        Decode and encode in overlapping tiles of tile_size latent pixels (tile_size * 8 image pixels) with blended
+        seams, to decode and encode large images with the memory of a tile. The result is close to, but not the same
+        as without tiling, because GroupNorm and attention see a tile only.
+        """
+        self.tile_size = tile_size
+        self.tile_overlap = overlap
+
+    def disable_tiling(self):
+        self.tile_size = None
+
+    def tiled_decode(self, latent, tile_size: int = 64, overlap: int = 16):
+        return tiled_forward(self._run_decoder, latent, tile_size, overlap)
+
+    def tiled_encode_moments(self, image, tile_size: int = 64, overlap: int = 16):
+        # tile sizes are in latent pixels
+        return tiled_forward(self._run_encoder, image, tile_size * 8, overlap * 8)
+
     def decode(self, latent):
-        return self.decoder(latent)
+        with self.autocast():
+            if self.tile_size is not None:
+                return self.tiled_decode(latent, self.tile_size, self.tile_overlap)
+            return self._run_decoder(latent)
 
-    @torch.autocast("cuda", dtype=torch.float16)
     def encode(self, image):
-        hidden = self.encoder(image)
-        mean, logvar = torch.chunk(hidden, 2, dim=1)
-        logvar = torch.clamp(logvar, -30.0, 20.0)
-        std = torch.exp(0.5 * logvar)
-        return mean + std * torch.randn_like(mean)
+        with self.autocast():
+            if self.tile_size is not None:
+                hidden = self.tiled_encode_moments(
+                    image, self.tile_size, self.tile_overlap
+                )
+            else:
+                hidden = self._run_encoder(image)
+            mean, logvar = torch.chunk(hidden, 2, dim=1)
+            logvar = torch.clamp(logvar, -30.0, 20.0)
+            std = torch.exp(0.5 * logvar)
+            return mean + std * torch.randn_like(mean)
+
+    def _footprint_key(
+        self, fn: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor
+    ):
+        # the input and every setting changing the memory of encode and decode
+        return (
+            fn.__name__,
+            tuple(x.shape[1:]),
+            x.dtype,
+            x.device.type,
+            self.precision,
+            self.tile_size,
+            self.tile_overlap if self.tile_size is not None else None,
+            self.channels_last,
+            self.compiled_encoder is not None or self.compiled_decoder is not None,
+        )
+
+    def _iter_batch_slices(
+        self,
+        fn: Callable[[torch.Tensor], torch.Tensor],
+        x: torch.Tensor,
+        memory_budget: Optional[int],
+        slice_size: Optional[int],
+    ) -> Iterator[torch.Tensor]:
+        if slice_size is None:
+            if memory_budget is None and x.device.type == "cuda":
+                free_memory, _ = torch.cuda.mem_get_info(x.device)
+                memory_budget = int(free_memory * 0.9)
+            if memory_budget is None:
+                slice_size = len(x)
+            else:
+                key = self._footprint_key(fn, x)
+                footprint = self.memory_footprints.get(key)
+                if footprint is None:
+                    # measure with the first image and keep its result
+                    out, footprint = measure_peak_memory(fn, x[:1])
+                    self.memory_footprints[key] = footprint
+                    logger.info(
+                        f"VAE {fn.__name__} footprint: {footprint / 2**20:.1f} MiB per image"
+                    )
+                    yield out
+                    x = x[1:]
+                slice_size = max(1, memory_budget // max(footprint, 1))
+
+        if len(x) == 0:
+            return
+        for x_slice in x.split(slice_size):
+            yield fn(x_slice)
+
+    def iter_decode(
+        self,
+        latent: torch.Tensor,
+        memory_budget: Optional[int] = None,
+        slice_size: Optional[int] = None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Decode a batch in slices and yield the images of each slice in order. The slice size is slice_size, or is
+        chosen to fit memory_budget bytes from the per image footprint measured on the first image (cached per shape).
+        On CUDA without both, the budget is 90% of the free memory; on other devices the batch is decoded at once.
+        """
+        return self._iter_batch_slices(self.decode, latent, memory_budget, slice_size)
+
+    def iter_encode(
+        self,
+        image: torch.Tensor,
+        memory_budget: Optional[int] = None,
+        slice_size: Optional[int] = None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Encode a batch in slices and yield the latents of each slice in order, see iter_decode.
+        """
+        return self._iter_batch_slices(self.encode, image, memory_budget, slice_size)
 
     @staticmethod
     def process_in(latent):
@@ -1471,6 +2243,40 @@ class SDVAE(torch.nn.Module):
         return (latent / VAE_SCALE_FACTOR) + VAE_SHIFT_FACTOR
 
 
+class LatentPreviewer(torch.nn.Module):
+    """
+    Approximates the VAE decoder with a linear map from the 16 latent channels to RGB at latent resolution, for per
+    step previews and thumbnails at a negligible cost. The input is the latent of SDVAE.decode (process_out applied).
+    """
+
+    def __init__(self, latent_channels: int = 16):
+        super().__init__()
+        self.proj = torch.nn.Conv2d(latent_channels, 3, kernel_size=1)
+
+    @torch.no_grad()
+    def fit(self, latents: torch.Tensor, images: torch.Tensor) -> "LatentPreviewer":
+        """
+        Least squares fit of the map to the images decoded from latents, eg. by SDVAE.decode, averaged over each 8x8
+        block of pixels. Fit it on sampled latents: the decode of random latents is far from any generated image.
+        """
+        images = images.float()
+        scale = images.shape[-1] // latents.shape[-1]
+        images = F.avg_pool2d(images, scale)
+
+        x = latents.float().permute(0, 2, 3, 1).reshape(-1, latents.shape[1])
+        x = torch.cat([x, torch.ones_like(x[:, :1])], dim=1)
+        y = images.permute(0, 2, 3, 1).reshape(-1, 3)
+        solution = torch.linalg.lstsq(x.cpu(), y.cpu()).solution  # (channels + 1, 3)
+
+        self.proj.weight.copy_(solution[:-1].T.reshape(self.proj.weight.shape))
+        self.proj.bias.copy_(solution[-1])
+        return self
+
+    def forward(self, latents: torch.Tensor) -> torch.Tensor:
+        # images in [-1, 1] at latent resolution
+        return self.proj(latents.to(self.proj.weight)).clamp(-1.0, 1.0)
+
+
 class VAEOutput:
     def __init__(self, latent):
         self.latent = latent
@@ -1529,7 +2335,8 @@ class CLIPAttention(torch.nn.Module):
         q = self.q_proj(x)
         k = self.k_proj(x)
         v = self.v_proj(x)
-        out = attention(q, k, v, self.heads, mask, mode=self.attn_mode)
+        head_dim = q.shape[-1] // self.heads
+        out = attention(q, k, v, head_dim, mask, mode=self.attn_mode)
         return self.out_proj(out)
 
 
@@ -1563,8 +2370,9 @@ class CLIPLayer(torch.nn.Module):
             intermediate_size,
             embed_dim,
             act_layer=ACTIVATIONS[intermediate_activation],
+            dtype=dtype,
+            device=device,
         )
-        self.mlp.to(device=device, dtype=dtype)
 
     def forward(self, x, mask=None):
         x += self.self_attn(self.layer_norm1(x), mask)
@@ -1958,7 +2766,7 @@ class T5Attention(torch.nn.Module):
                 self.relative_attention_num_buckets, self.num_heads, device=device
             )
 
-        self.attn_mode = "xformers"  # TODO 何とかする
+        self.attn_mode = "torch"
 
     def set_attn_mode(self, mode):
         self.attn_mode = mode
@@ -2048,14 +2856,9 @@ class T5Attention(torch.nn.Module):
             past_bias = self.compute_bias(x.shape[1], x.shape[1], x.device)
         if past_bias is not None:
             mask = past_bias
-        out = attention(
-            q,
-            k * ((k.shape[-1] / self.num_heads) ** 0.5),
-            v,
-            self.num_heads,
-            mask,
-            mode=self.attn_mode,
-        )
+        # T5 does not scale the attention scores
+        head_dim = q.shape[-1] // self.num_heads
+        out = attention(q, k, v, head_dim, mask, scale=1.0, mode=self.attn_mode)
         return self.o(out), past_bias
 
 
@@ -2217,11 +3020,12 @@ def create_clip_l(
         )
     if state_dict is not None:
         # update state_dict if provided to include logit_scale and text_projection.weight avoid errors
+        # use fresh tensors instead of the module's own parameters: the model may be built on meta device
         if "logit_scale" not in state_dict:
-            state_dict["logit_scale"] = clip_l.logit_scale
+            state_dict["logit_scale"] = torch.tensor(4.6055)
         if "transformer.text_projection.weight" not in state_dict:
-            state_dict["transformer.text_projection.weight"] = (
-                clip_l.transformer.text_projection.weight
+            state_dict["transformer.text_projection.weight"] = torch.eye(
+                CLIPL_CONFIG["hidden_size"]
             )
     return clip_l
 
@@ -2245,7 +3049,7 @@ def create_clip_g(
         clip_g = SDXLClipG(CLIPG_CONFIG, device=device, dtype=dtype)
     if state_dict is not None:
         if "logit_scale" not in state_dict:
-            state_dict["logit_scale"] = clip_g.logit_scale
+            state_dict["logit_scale"] = torch.tensor(4.6055)
     return clip_g
 
 
@@ -2265,7 +3069,7 @@ def create_t5xxl(
         t5 = T5XXLModel(T5_CONFIG, dtype=dtype, device=device)
     if state_dict is not None:
         if "logit_scale" not in state_dict:
-            state_dict["logit_scale"] = t5.logit_scale
+            state_dict["logit_scale"] = torch.tensor(4.6055)
         if "transformer.shared.weight" in state_dict:
             state_dict.pop("transformer.shared.weight")
     return t5
@@ -0,0 +1,458 @@
+import pytest
+import torch
+
+from networks.stable_diffusion3 import sd3_models
+from networks.stable_diffusion3.sd3_test_utils import create_tiny_mmdit
+
+
+def make_inputs(batch_size=2, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(batch_size, 16, 8, 8, generator=generator)
+    t = torch.full((batch_size,), 500.0)
+    context = torch.randn(batch_size, 8, 64, generator=generator)
+    y = torch.randn(batch_size, 32, generator=generator)
+    return x, t, context, y
+
+
+def make_qkv(batch_size=2, length=40, heads=4, head_dim=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [
+        torch.randn(batch_size, length, heads * head_dim, generator=generator)
+        for _ in range(3)
+    ]
+
+
+@pytest.mark.parametrize("mode", ["chunked", "tiled", "math", "xformers"])
+@pytest.mark.parametrize("mask_type", [None, "bool", "bias"])
+def test_attention_backends(monkeypatch, mode, mask_type):
+    if mode == "xformers":
+        # otherwise the torch fallback is tested
+        pytest.importorskip("xformers")
+    monkeypatch.setattr(sd3_models, "ATTENTION_CHUNK_SIZE", 16)
+    q, k, v = make_qkv()
+    mask = None
+    if mask_type == "bool":
+        mask = torch.ones(40, 40, dtype=torch.bool).tril()
+    elif mask_type == "bias":
+        mask = torch.randn(1, 4, 40, 40, generator=torch.Generator().manual_seed(1))
+
+    expected = sd3_models.attention(q, k, v, 8, mask, mode="torch")
+    out = sd3_models.attention(q, k, v, 8, mask, mode=mode)
+    assert out.shape == q.shape
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_attention_backend_fallback(monkeypatch):
+    monkeypatch.setattr(sd3_models, "memory_efficient_attention", None)
+    backends = sd3_models.ATTENTION_BACKENDS
+    assert sd3_models.resolve_attention_backend("xformers") is backends["torch"]
+    assert sd3_models.resolve_attention_backend("torch", scale=0.5) is backends["torch"]
+    with pytest.raises(ValueError):
+        sd3_models.resolve_attention_backend("unknown")
+
+
+def test_clip_attention_heads():
+    from transformers import CLIPTextConfig
+    from transformers.models.clip.modeling_clip import CLIPAttention
+
+    config = CLIPTextConfig(hidden_size=32, num_attention_heads=2)
+    reference = CLIPAttention(config).eval()
+    attn = sd3_models.CLIPAttention(32, 2, torch.float32, "cpu", mode="torch")
+    for name in ["q_proj", "k_proj", "v_proj", "out_proj"]:
+        getattr(attn, name).load_state_dict(getattr(reference, name).state_dict())
+
+    x = torch.randn(2, 7, 32, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        expected = reference(x)[0]
+        assert torch.allclose(attn(x), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ["torch", "chunked", "tiled", "math"])
+def test_attention_scale(monkeypatch, mode):
+    monkeypatch.setattr(sd3_models, "ATTENTION_CHUNK_SIZE", 16)
+    q, k, v = make_qkv()
+    # scaling k is the same as scaling the scores
+    expected = sd3_models.attention(q, k * (0.5 * 8**0.5), v, 8, mode="math")
+    out = sd3_models.attention(q, k, v, 8, scale=0.5, mode=mode)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_t5_matches_transformers():
+    from transformers import T5Config, T5EncoderModel
+
+    config = T5Config(
+        vocab_size=100,
+        d_model=32,
+        d_kv=8,
+        d_ff=64,
+        num_layers=2,
+        num_heads=4,
+        feed_forward_proj="gated-gelu",
+    )
+    torch.manual_seed(0)
+    reference = T5EncoderModel(config).eval()
+    t5 = sd3_models.T5(
+        {"d_ff": 64, "d_model": 32, "num_heads": 4, "num_layers": 2, "vocab_size": 100},
+        torch.float32,
+        "cpu",
+    )
+    missing, unexpected = t5.load_state_dict(reference.state_dict(), strict=False)
+    assert missing == [] and unexpected == ["shared.weight"]
+
+    input_ids = torch.randint(
+        0, 100, (2, 12), generator=torch.Generator().manual_seed(1)
+    )
+    with torch.no_grad():
+        expected = reference(input_ids).last_hidden_state
+        for mode in ["torch", "math"]:
+            t5.encoder.block.apply(
+                lambda m: m.set_attn_mode(mode) if hasattr(m, "set_attn_mode") else None
+            )
+            assert torch.allclose(t5(input_ids)[0], expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("with_shift", [True, False])
+def test_modulate(with_shift):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(2, 5, 8, generator=generator)
+    scale = torch.randn(2, 8, generator=generator)
+    shift = torch.randn(2, 8, generator=generator) if with_shift else None
+    expected = x * (1 + scale.unsqueeze(1))
+    if with_shift:
+        expected = expected + shift.unsqueeze(1)
+
+    out = sd3_models.modulate(x, shift, scale)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+    # autograd needs x, it is not overwritten
+    x_grad = x.clone().requires_grad_()
+    out = sd3_models.modulate(x_grad, shift, scale, inplace=True)
+    assert torch.allclose(out, expected, atol=1e-6)
+    assert out.data_ptr() != x_grad.data_ptr()
+
+    with torch.no_grad():
+        x_temp = x.clone()
+        out = sd3_models.modulate(x_temp, shift, scale, inplace=True)
+    assert torch.allclose(out, expected, atol=1e-6)
+    assert out.data_ptr() == x_temp.data_ptr()
+
+
+@torch.no_grad()
+def test_joint_qkv_buffer(monkeypatch):
+    mmdit = create_tiny_mmdit(depth=4)
+    x, t, context, y = make_inputs()
+    block = mmdit.joint_blocks[0]
+    assert block._can_use_joint_qkv(context[:, :, :256], x.new_zeros(2, 16, 256))
+    out = mmdit(x, t, y=y, context=context)
+
+    monkeypatch.setattr(sd3_models.MMDiTBlock, "_can_use_joint_qkv", lambda *_: False)
+    assert torch.allclose(mmdit(x, t, y=y, context=context), out, atol=1e-5)
+
+
+@torch.no_grad()
+def test_prepare_conditioning():
+    mmdit = create_tiny_mmdit(depth=4)
+    x, t, context, y = make_inputs()
+    expected = mmdit(x, t, y=y, context=context)
+
+    conditioning = mmdit.prepare_conditioning(y, context)
+    out = mmdit(x, t, prepared_conditioning=conditioning)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+    first = tuple(c[:1] for c in conditioning)
+    out = mmdit(x[:1], t[:1], prepared_conditioning=first)
+    assert torch.allclose(out, expected[:1], atol=1e-6)
+
+
+def test_fuse_adaln_modulation():
+    mmdit = create_tiny_mmdit(depth=4)
+    x, t, context, y = make_inputs()
+    with torch.no_grad():
+        expected = mmdit(x, t, y=y, context=context)
+
+    keys = list(mmdit.state_dict().keys())
+    mmdit.fuse_adaln_modulation()
+    assert list(mmdit.state_dict().keys()) == keys
+    with torch.no_grad():
+        assert mmdit.fused_adaln is not None
+        assert torch.allclose(mmdit(x, t, y=y, context=context), expected, atol=1e-5)
+
+    # autograd uses the parameters of each block
+    out = mmdit(x, t, y=y, context=context)
+    out.sum().backward()
+    assert mmdit.joint_blocks[0].x_block.adaLN_modulation[-1].weight.grad is not None
+
+    # moved weights are not views of the fused weight anymore
+    mmdit.double()
+    with torch.no_grad():
+        out = mmdit(x.double(), t, y=y.double(), context=context.double())
+    assert mmdit.fused_adaln is None
+    assert torch.allclose(out.float(), expected, atol=1e-5)
+
+
+@torch.no_grad()
+def test_pos_embed_cache():
+    mmdit = create_tiny_mmdit(depth=4)
+    pos_embed = mmdit.get_pos_embed(8, 6, torch.float16, "cpu")
+    assert pos_embed.dtype == torch.float16 and pos_embed.is_contiguous()
+    assert torch.equal(pos_embed, mmdit.cropped_pos_embed(8, 6).half())
+    assert mmdit.get_pos_embed(8, 6, torch.float16, "cpu") is pos_embed
+
+    # invalidated when the weights change
+    state_dict = {k: v.clone() for k, v in mmdit.state_dict().items()}
+    state_dict["pos_embed"].normal_()
+    mmdit.load_state_dict(state_dict)
+    updated = mmdit.get_pos_embed(8, 6, torch.float16, "cpu")
+    assert torch.equal(updated, mmdit.cropped_pos_embed(8, 6).half())
+    assert not torch.equal(updated, pos_embed)
+
+    for h in range(2, 2 + sd3_models.POS_EMBED_CACHE_SIZE + 1):
+        mmdit.get_pos_embed(h, h, torch.float32, "cpu")
+    assert len(mmdit.pos_embed_cache) == sd3_models.POS_EMBED_CACHE_SIZE
+    assert (2, 2, torch.float32, torch.device("cpu")) not in mmdit.pos_embed_cache
+
+
+@torch.no_grad()
+def test_feature_cache_threshold():
+    mmdit = create_tiny_mmdit(depth=4)
+    x, t, context, y = make_inputs()
+    expected = mmdit(x, t, y=y, context=context)
+    expected_changed = mmdit(x * 1.001, t, y=y, context=context)
+
+    feature_cache = sd3_models.MMDiTFeatureCache(threshold=0.05)
+    mmdit.enable_feature_cache(feature_cache)
+    assert torch.allclose(mmdit(x, t, y=y, context=context), expected, atol=1e-6)
+
+    # blocks 1 and 2 are cached, the input changes little
+    out = mmdit(x * 1.001, t, y=y, context=context)
+    assert torch.allclose(out, expected_changed, atol=1e-3)
+    assert feature_cache.skipped_blocks == [0, 2]
+
+    # a large change runs the blocks again
+    mmdit(x * 2, t, y=y, context=context)
+    assert feature_cache.skipped_blocks[-1] == 0
+
+    # a different batch size never reuses the residuals
+    feature_cache.reset()
+    mmdit(x, t, y=y, context=context)
+    mmdit(x[:1], t[:1], y=y[:1], context=context[:1])
+    assert feature_cache.skipped_blocks == [0, 0]
+
+    mmdit.disable_feature_cache()
+    assert torch.allclose(mmdit(x, t, y=y, context=context), expected)
+
+
+@torch.no_grad()
+def test_feature_cache_interval():
+    mmdit = create_tiny_mmdit(depth=4)
+    x, t, context, y = make_inputs()
+    feature_cache = sd3_models.MMDiTFeatureCache(interval=2, start_block=0)
+    mmdit.enable_feature_cache(feature_cache)
+    for i in range(4):
+        mmdit(x * (i + 1), t, y=y, context=context)
+    assert feature_cache.skipped_blocks == [0, 3, 0, 3]
+
+
+def create_vae():
+    # SDVAE with a small encoder and decoder, 4x downscale
+    torch.manual_seed(0)
+    vae = sd3_models.SDVAE()
+    vae.encoder = sd3_models.VAEEncoder(ch=32, ch_mult=(1, 2, 2), num_res_blocks=1)
+    vae.decoder = sd3_models.VAEDecoder(ch=32, ch_mult=(1, 2, 2), num_res_blocks=1)
+    return vae.eval()
+
+
+def test_tiled_forward():
+    # a pointwise op is reproduced exactly, whatever the tiling
+    x = torch.randn(1, 3, 20, 28)
+
+    def fn(tile):
+        return torch.nn.functional.interpolate(tile, scale_factor=2) * 2 + 1
+
+    for tile_size, overlap in [(8, 4), (12, 3), (32, 8)]:
+        out = sd3_models.tiled_forward(fn, x, tile_size, overlap)
+        assert torch.allclose(out, fn(x), atol=1e-6)
+
+
+@torch.no_grad()
+def psnr(x, reference):
+    # in dB, relative to the value range of the reference
+    value_range = reference.max() - reference.min()
+    return 10 * torch.log10(value_range**2 / ((x - reference) ** 2).mean()).item()
+
+
+@torch.no_grad()
+def test_vae_tiling():
+    vae = create_vae()
+    latent = torch.randn(1, 16, 24, 24)
+    expected = vae.decode(latent)
+
+    # a single tile is the full decode, up to float rounding
+    vae.enable_tiling(24, 8)
+    assert torch.allclose(vae.decode(latent), expected, rtol=0, atol=1e-6)
+
+    # GroupNorm and attention see a tile only, so smaller tiles are close but not equal. With the random weights of
+    # this VAE, non-overlapping tiles reach about 25 dB and blended 8 pixel overlaps about 36 dB: the bound fails if
+    # the blending is broken (seams) or a tile is misplaced (far below 25 dB)
+    vae.enable_tiling(16, 8)
+    tiled = vae.decode(latent)
+    assert tiled.shape == expected.shape
+    assert psnr(tiled, expected) > 32
+
+    image = torch.rand(1, 3, 96, 96) * 2 - 1
+    vae.disable_tiling()
+    expected = vae.encoder(image)
+    tiled = vae.tiled_encode_moments(image, 8, 4)
+    assert tiled.shape == expected.shape
+    # about 24 dB without overlap, 34.5 dB with it
+    assert psnr(tiled, expected) > 31
+    vae.enable_tiling(8, 4)
+    assert vae.encode(image).shape == (1, 16, 24, 24)
+
+
+@torch.no_grad()
+def test_vae_encoder_slice_size():
+    vae = create_vae()
+    image = torch.rand(5, 3, 32, 32) * 2 - 1
+    expected = vae.encoder(image)
+    assert torch.allclose(vae.encoder(image, slice_size=2), expected, atol=1e-5)
+
+
+def test_memory_counter():
+    x = torch.randn(256, 256)
+
+    def fn(x):
+        y = x * 2  # freed after the next op
+        z = y + 1
+        del y
+        return z * 3
+
+    counter = sd3_models.MemoryCounter()
+    with counter:
+        out = fn(x)
+    assert torch.allclose(out, (x * 2 + 1) * 3)
+    assert counter.allocated_bytes == 3 * x.nbytes
+    assert counter.peak_bytes == 2 * x.nbytes
+
+    out, peak_bytes = sd3_models.measure_peak_memory(fn, x)
+    assert peak_bytes == 2 * x.nbytes
+
+
+@torch.no_grad()
+def test_vae_iter_decode():
+    vae = create_vae()
+    latent = torch.randn(5, 16, 8, 8)
+    expected = vae.decode(latent)
+
+    slices = list(vae.iter_decode(latent, slice_size=2))
+    assert [len(s) for s in slices] == [2, 2, 1]
+    assert torch.allclose(torch.cat(slices), expected, atol=1e-5)
+
+    # the first image is decoded alone to measure the footprint, the rest in slices fitting the budget
+    slices = list(vae.iter_decode(latent, memory_budget=1))
+    assert [len(s) for s in slices] == [1, 1, 1, 1, 1]
+    (footprint,) = vae.memory_footprints.values()
+    assert footprint > 0
+    slices = list(vae.iter_decode(latent, memory_budget=footprint * 3))
+    assert [len(s) for s in slices] == [3, 2]
+    assert torch.allclose(torch.cat(slices), expected, atol=1e-5)
+
+    # the footprint is measured again when a setting changes the memory of decode
+    vae.enable_tiling(4, 2)
+    slices = list(vae.iter_decode(latent, memory_budget=footprint * 3))
+    assert len(vae.memory_footprints) == 2
+    vae.set_precision("bf16")
+    slices = list(vae.iter_decode(latent, memory_budget=footprint * 3))
+    assert len(vae.memory_footprints) == 3
+
+
+@torch.no_grad()
+def test_vae_precision():
+    vae = create_vae()
+    latent = torch.randn(1, 16, 8, 8)
+    vae.set_precision("fp32")
+    expected = vae.decode(latent)
+
+    # fp16 autocast is CUDA only
+    vae.set_precision("fp16")
+    assert torch.equal(vae.decode(latent), expected)
+
+    vae.set_precision("bf16")
+    images = vae.decode(latent)
+    assert images.dtype == torch.bfloat16
+    assert (images.float() - expected).abs().mean() < 0.05 * expected.abs().mean()
+
+    with pytest.raises(ValueError):
+        vae.set_precision("fp8")
+
+
+def test_group_norm_fp32():
+    norm = sd3_models.Normalize(64)
+    x = torch.randn(2, 64, 8, 8) * 100 + 50
+    expected = norm(x)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        out = norm(x.bfloat16())
+    assert out.dtype == torch.bfloat16
+    # only the rounding of the input and the output
+    assert torch.allclose(out.float(), expected, atol=0.05)
+
+
+@torch.no_grad()
+def test_vae_optimize_for_inference():
+    vae = create_vae()
+    vae.set_precision("fp32")
+    latent = torch.randn(2, 16, 8, 8)
+    image = torch.rand(2, 3, 32, 32) * 2 - 1
+    expected_images = vae.decode(latent)
+    expected_moments = vae.encoder(image)
+    keys = set(vae.state_dict().keys())
+
+    vae.optimize_for_inference()
+    images = vae.decode(latent)
+    assert images.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(images, expected_images, atol=1e-4)
+    assert torch.allclose(
+        vae.tiled_encode_moments(image, 4, 0), expected_moments, atol=1e-4
+    )
+    assert set(vae.state_dict().keys()) == keys
+
+    vae.optimize_for_inference(channels_last=False, fuse_qkv=False)
+    assert torch.allclose(vae.decode(latent), expected_images, atol=1e-4)
+
+
+def test_attn_block_fuse_qkv_with_grad_enabled():
+    block = sd3_models.AttnBlock(32)
+    block.fuse_qkv()
+    # fused outside autograd, so the weights can be trained and fused again
+    assert not block.qkv_weight.requires_grad
+    assert block.qkv_weight.grad_fn is None
+    assert block.qkv_bias.grad_fn is None
+
+
+@torch.no_grad()
+def test_latent_previewer():
+    # a linear decoder is fitted exactly
+    weight = torch.randn(3, 16, 1, 1) * 0.1
+    bias = torch.randn(3) * 0.1
+
+    def decode(latents):
+        images = torch.nn.functional.conv2d(latents, weight, bias)
+        return torch.nn.functional.interpolate(images, scale_factor=8)
+
+    latents = torch.randn(2, 16, 8, 8)
+    previewer = sd3_models.LatentPreviewer().fit(latents, decode(latents))
+    assert torch.allclose(previewer.proj.weight, weight, atol=1e-4)
+    assert torch.allclose(previewer.proj.bias, bias, atol=1e-4)
+
+    latents = torch.randn(1, 16, 4, 6)
+    expected = torch.nn.functional.conv2d(latents, weight, bias).clamp(-1, 1)
+    assert torch.allclose(previewer(latents), expected, atol=1e-4)
+
+    # the VAE can be fitted
+    vae = create_vae()
+    previewer = sd3_models.LatentPreviewer().fit(latents, vae.decode(latents))
+    assert previewer(latents).shape == (1, 3, 4, 6)
+
+
+if __name__ == "__main__":
+    pytest.main()
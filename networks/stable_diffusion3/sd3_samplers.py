@@ -0,0 +1,143 @@
+# samplers for Discrete Flow models: x = (1 - sigma) * x0 + sigma * noise, solved as ODE dx/dsigma = (x - x0) / sigma
+# some samplers are adapted from k-diffusion https://github.com/crowsonkb/k-diffusion
+
+from typing import Callable, Dict, Optional
+import torch
+from tqdm import tqdm
+
+# denoise(x, sigma) -> predicted x0 (denoised), sigma is a 0-dim tensor
+DenoiseFn = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+# callback(step, sigma, x, denoised) after each step, with x after the step and the prediction of its first evaluation
+StepCallback = Callable[[int, torch.Tensor, torch.Tensor, torch.Tensor], None]
+
+
+def to_d(x: torch.Tensor, sigma: torch.Tensor, denoised: torch.Tensor):
+    return (x - denoised) / sigma
+
+
+@torch.no_grad()
+def sample_euler(
+    denoise: DenoiseFn,
+    x: torch.Tensor,
+    sigmas: torch.Tensor,
+    callback: Optional[StepCallback] = None,
+):
+    """First order Euler method, one model evaluation per step."""
+    for i in tqdm(range(len(sigmas) - 1)):
+        sigma = sigmas[i]
+        denoised = denoise(x, sigma)
+        d = to_d(x, sigma, denoised)
+        dt = sigmas[i + 1] - sigma
+        x = (x + d * dt).to(x.dtype)
+        if callback is not None:
+            callback(i, sigma, x, denoised)
+    return x
+
+
+@torch.no_grad()
+def sample_heun(
+    denoise: DenoiseFn,
+    x: torch.Tensor,
+    sigmas: torch.Tensor,
+    callback: Optional[StepCallback] = None,
+):
+    """Second order Heun method, two model evaluations per step except the last step (Euler)."""
+    for i in tqdm(range(len(sigmas) - 1)):
+        sigma, sigma_next = sigmas[i], sigmas[i + 1]
+        denoised = denoise(x, sigma)
+        d = to_d(x, sigma, denoised)
+        dt = sigma_next - sigma
+        if sigma_next == 0:
+            x = (x + d * dt).to(x.dtype)
+        else:
+            x_2 = (x + d * dt).to(x.dtype)
+            d_2 = to_d(x_2, sigma_next, denoise(x_2, sigma_next))
+            x = (x + (d + d_2) / 2 * dt).to(x.dtype)
+        if callback is not None:
+            callback(i, sigma, x, denoised)
+    return x
+
+
+@torch.no_grad()
+def sample_midpoint(
+    denoise: DenoiseFn,
+    x: torch.Tensor,
+    sigmas: torch.Tensor,
+    callback: Optional[StepCallback] = None,
+):
+    """Second order explicit midpoint (RK2) method, two model evaluations per step."""
+    for i in tqdm(range(len(sigmas) - 1)):
+        sigma, sigma_next = sigmas[i], sigmas[i + 1]
+        sigma_mid = (sigma + sigma_next) / 2
+        denoised = denoise(x, sigma)
+        d = to_d(x, sigma, denoised)
+        x_mid = (x + d * (sigma_mid - sigma)).to(x.dtype)
+        d_mid = to_d(x_mid, sigma_mid, denoise(x_mid, sigma_mid))
+        x = (x + d_mid * (sigma_next - sigma)).to(x.dtype)
+        if callback is not None:
+            callback(i, sigma, x, denoised)
+    return x
+
+
+@torch.no_grad()
+def sample_dpmpp_2m(
+    denoise: DenoiseFn,
+    x: torch.Tensor,
+    sigmas: torch.Tensor,
+    callback: Optional[StepCallback] = None,
+):
+    """
+    DPM-Solver++(2M) with alpha = 1 - sigma, one model evaluation per step.
+    lambda = log(alpha / sigma) is -inf at sigma = 1, so the first step is first order (same as DDIM).
+    """
+    dtype = x.dtype
+    input_sigmas = sigmas  # passed to the callback as given, same as the other samplers
+    sigmas = sigmas.double()  # lambda is sensitive to precision near sigma = 0 and 1
+
+    def lambda_fn(sigma):
+        return torch.log((1 - sigma) / sigma)
+
+    old_denoised = None
+    h_last = None
+    for i in tqdm(range(len(sigmas) - 1)):
+        sigma, sigma_next = sigmas[i], sigmas[i + 1]
+        denoised = denoise(x, sigma.float())
+
+        if sigma_next == 0:
+            # last step: x is the prediction itself
+            x = denoised.to(dtype)
+            if callback is not None:
+                callback(i, input_sigmas[i], x, denoised)
+            break
+
+        alpha, alpha_next = 1 - sigma, 1 - sigma_next
+        # 1 - exp(-h) without computing h, which is infinite at sigma = 1
+        one_minus_exp_neg_h = 1 - (alpha * sigma_next) / (sigma * alpha_next)
+        h = lambda_fn(sigma_next) - lambda_fn(sigma)
+
+        if old_denoised is None or not torch.isfinite(h_last):
+            d = denoised
+        else:
+            r = h_last / h
+            d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_denoised
+
+        x = (sigma_next / sigma) * x + alpha_next * one_minus_exp_neg_h * d
+        x = x.to(dtype)
+        if callback is not None:
+            callback(i, input_sigmas[i], x, denoised)
+        old_denoised = denoised
+        h_last = h
+    return x
+
+
+SAMPLERS: Dict[
+    str,
+    Callable[
+        [DenoiseFn, torch.Tensor, torch.Tensor, Optional[StepCallback]], torch.Tensor
+    ],
+] = {
+    "euler": sample_euler,
+    "heun": sample_heun,
+    "midpoint": sample_midpoint,
+    "dpmpp_2m": sample_dpmpp_2m,
+}
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+from networks.stable_diffusion3 import sd3_samplers, sd3_utils
+from networks.stable_diffusion3.sd3_test_utils import create_tiny_mmdit
+
+
+@pytest.fixture
+def denoise():
+    mmdit = create_tiny_mmdit()
+
+    generator = torch.Generator().manual_seed(0)
+    context = torch.randn(1, 8, 64, generator=generator)
+    y = torch.randn(1, 32, generator=generator)
+    model_sampling = sd3_utils.ModelSamplingDiscreteFlow()
+
+    def denoise(x, sigma):
+        denoise.num_evals += 1
+        timestep = model_sampling.timestep(sigma).float().expand(x.shape[0])
+        model_output = mmdit(x, timestep, context=context, y=y)
+        return model_sampling.calculate_denoised(sigma, model_output, x)
+
+    denoise.num_evals = 0
+    return denoise
+
+
+def run(denoise, name, steps):
+    sigmas = sd3_utils.ModelSamplingDiscreteFlow().get_sigmas(steps)
+    noise = torch.randn(1, 16, 4, 4, generator=torch.Generator().manual_seed(1))
+    denoise.num_evals = 0
+    return sd3_samplers.SAMPLERS[name](denoise, noise * sigmas[0], sigmas)
+
+
+@pytest.mark.parametrize("name", ["heun", "midpoint", "dpmpp_2m"])
+def test_sampler_converges_to_euler(denoise, name):
+    errors = []
+    for steps in [10, 200]:
+        euler = run(denoise, "euler", steps)
+        errors.append((run(denoise, name, steps) - euler).abs().max().item())
+    # all samplers solve the same ODE, the difference shrinks with the step size
+    assert errors[1] < errors[0] / 10
+    assert errors[1] < 1e-3
+
+
+@pytest.mark.parametrize(
+    "name, num_evals",
+    [("euler", 10), ("heun", 19), ("midpoint", 20), ("dpmpp_2m", 10)],
+)
+def test_sampler_model_evaluations(denoise, name, num_evals):
+    run(denoise, name, 10)
+    assert denoise.num_evals == num_evals
+
+
+@pytest.mark.parametrize("name", ["euler", "heun", "midpoint", "dpmpp_2m"])
+def test_sampler_callback(denoise, name):
+    sigmas = sd3_utils.ModelSamplingDiscreteFlow().get_sigmas(5)
+    noise = torch.randn(1, 16, 4, 4, generator=torch.Generator().manual_seed(1))
+    calls = []
+
+    def callback(step, sigma, x, denoised):
+        calls.append((step, sigma, x, denoised))
+
+    x = sd3_samplers.SAMPLERS[name](denoise, noise * sigmas[0], sigmas, callback)
+    assert [step for step, *_ in calls] == list(range(5))
+    # the sigmas are passed as given, whatever precision the sampler computes in
+    for i, (_, sigma, *_) in enumerate(calls):
+        assert sigma.dtype == sigmas.dtype
+        assert torch.equal(sigma, sigmas[i])
+    assert torch.equal(calls[-1][2], x)
+    assert calls[-1][3].shape == x.shape
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,28 @@
+# helpers shared by the tests of the SD3 modules
+
+import torch
+
+from networks.stable_diffusion3 import sd3_models
+
+
+def create_tiny_mmdit(depth: int = 2) -> sd3_models.MMDiT:
+    """
+    A seeded MMDiT with random weights for tests: 16 latent channels, 32 dim pooled and 64 dim context embeddings,
+    latents up to 32x32 (16x16 patches).
+    """
+    torch.manual_seed(0)
+    mmdit = sd3_models.MMDiT(
+        input_size=None,
+        pos_embed_max_size=16,
+        patch_size=2,
+        in_channels=16,
+        adm_in_channels=32,
+        depth=depth,
+        num_patches=256,
+        context_size=64,
+        attn_mode="torch",
+    )
+    # pos_embed is an uninitialized buffer, so initialize all tensors and not only the parameters
+    for tensor in mmdit.state_dict().values():
+        tensor.normal_(0, 0.02)
+    return mmdit.eval()
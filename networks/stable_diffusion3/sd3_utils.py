@@ -1,10 +1,17 @@
 from ast import List
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import json
 import math
+import os
 import sys
-from typing import Dict, Optional, Union
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Union
 import torch
 import safetensors
-from safetensors.torch import load_file
+from safetensors.torch import load_file, save_file
 from accelerate import init_empty_weights
 from accelerate.utils.modeling import set_module_tensor_to_device
 import logging
@@ -51,6 +58,176 @@ def _load_state_dict_on_device(model, state_dict, device, dtype=None):
     )
 
 
+@contextmanager
+def _record_time(load_times: Dict[str, float], name: str):
+    # accumulate elapsed time per component, a component may be timed in several phases
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        load_times[name] = load_times.get(name, 0.0) + time.perf_counter() - start
+
+
+# accelerate's init_empty_weights patches nn.Module globally, so models must not be built concurrently
+_build_lock = threading.Lock()
+
+
+def _run_tasks(
+    tasks: Dict[str, Callable[[], Any]],
+    max_workers: int,
+    load_times: Dict[str, float],
+) -> Dict[str, Any]:
+    # results are ordered as tasks regardless of the completion order, so loading is deterministic
+    def run(name: str, fn: Callable[[], Any]):
+        with _record_time(load_times, name):
+            return fn()
+
+    for name in tasks:
+        load_times.setdefault(name, 0.0)  # keep the report in the order of tasks
+
+    if max_workers <= 1 or len(tasks) <= 1:
+        return {name: run(name, fn) for name, fn in tasks.items()}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = {name: executor.submit(run, name, fn) for name, fn in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _load_safetensors(
+    path: str, device: Union[str, torch.device], disable_mmap: bool = False
+) -> Dict[str, torch.Tensor]:
+    if disable_mmap:
+        return safetensors.torch.load(open(path, "rb").read())
+    else:
+        try:
+            return load_file(path, device=device)
+        except:
+            return load_file(path)  # prevent device invalid Error
+
+
+def _build_model(
+    name: str,
+    state_dict: Dict[str, torch.Tensor],
+    attn_mode: str,
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+):
+    logger.info(f"Building {name}")
+    with _build_lock, init_empty_weights():
+        if name == "mmdit":
+            model = sd3_models.create_mmdit_sd3_medium_configs(attn_mode)
+        elif name == "clip_l":
+            model = sd3_models.create_clip_l(device, dtype, state_dict)
+        elif name == "clip_g":
+            model = sd3_models.create_clip_g(device, dtype, state_dict)
+        elif name == "t5xxl":
+            model = sd3_models.create_t5xxl(state_dict, device, dtype)
+        elif name == "vae":
+            model = sd3_models.SDVAE(dtype=dtype)
+        else:
+            raise ValueError(f"unknown model: {name}")
+
+    # text encoders are built with their own dtype (embeddings are kept in fp32), so dtype is not forced here
+    is_text_encoder = name in ("clip_l", "clip_g", "t5xxl")
+    info = _load_state_dict_on_device(
+        model, state_dict, device, None if is_text_encoder else dtype
+    )
+    logger.info(f"Loaded {name}: {info}")
+    if is_text_encoder:
+        model.set_attn_mode(attn_mode)
+    return model
+
+
+CONVERTED_MANIFEST_NAME = "manifest.json"
+CONVERTED_MODEL_NAMES = ["mmdit", "clip_l", "clip_g", "t5xxl", "vae"]
+DTYPE_NAMES = {torch.float32: "fp32", torch.float16: "fp16", torch.bfloat16: "bf16"}
+
+
+def save_converted_models(output_dir: str, **models: Optional[torch.nn.Module]):
+    """
+    Save models built by load_models as already renamed and cast safetensors files (eg. mmdit.bf16.safetensors)
+    with a manifest. load_models loads the directory without renaming or casting.
+    models: mmdit, clip_l, clip_g, t5xxl and vae. None is skipped.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    components = {}
+    for name, model in models.items():
+        assert name in CONVERTED_MODEL_NAMES, f"unknown model: {name}"
+        if model is None:
+            continue
+
+        if name in ("clip_l", "clip_g", "t5xxl"):
+            dtype = model.transformer.dtype  # embeddings are fp32 regardless of this
+        else:
+            dtype = next(model.parameters()).dtype
+        dtype_name = DTYPE_NAMES[dtype]
+        file_name = f"{name}.{dtype_name}.safetensors"
+
+        logger.info(f"Saving {name} to {file_name}...")
+        state_dict = {k: v.detach().contiguous() for k, v in model.state_dict().items()}
+        save_file(
+            state_dict, os.path.join(output_dir, file_name), metadata={"format": "pt"}
+        )
+        components[name] = {"file": file_name, "dtype": dtype_name}
+
+    with open(os.path.join(output_dir, CONVERTED_MANIFEST_NAME), "w") as f:
+        json.dump({"version": 1, "components": components}, f, indent=2)
+    logger.info(f"Saved converted models to {output_dir}")
+
+
+def _load_converted_models(
+    model_dir: str,
+    attn_mode: str,
+    device: Union[str, torch.device],
+    weight_dtype: torch.dtype,
+    disable_mmap: bool,
+    t5xxl_device: Union[str, torch.device],
+    t5xxl_dtype: Optional[torch.dtype],
+    use_t5xxl: bool,
+    max_workers: int,
+):
+    with open(os.path.join(model_dir, CONVERTED_MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    components = manifest["components"]
+    dtypes_by_name = {v: k for k, v in DTYPE_NAMES.items()}
+
+    def read_and_build(name: str, path: str, dvc, dtype: torch.dtype):
+        state_dict = _load_safetensors(path, dvc, disable_mmap)
+        return _build_model(name, state_dict, attn_mode, dvc, dtype)
+
+    tasks = {}
+    for name in CONVERTED_MODEL_NAMES:
+        if name not in components or (name == "t5xxl" and not use_t5xxl):
+            continue
+        dvc = t5xxl_device if name == "t5xxl" else device
+        saved_dtype = dtypes_by_name[components[name]["dtype"]]
+        dtype = weight_dtype
+        if name == "t5xxl":
+            # t5xxl may be exported in another dtype than the other models
+            dtype = t5xxl_dtype or saved_dtype
+        if saved_dtype != dtype:
+            logger.warning(
+                f"{name} is saved in {components[name]['dtype']}, cast to {dtype} while loading"
+            )
+        path = os.path.join(model_dir, components[name]["file"])
+        logger.info(f"Loading {name} from {path}...")
+        tasks[name] = partial(read_and_build, name, path, dvc, dtype)
+
+    load_times: Dict[str, float] = {}
+    models = _run_tasks(tasks, max_workers, load_times)
+    logger.info(
+        "Load times: "
+        + ", ".join(f"{name}: {sec:.2f}s" for name, sec in load_times.items())
+    )
+    return (
+        models["mmdit"],
+        models.get("clip_l"),
+        models.get("clip_g"),
+        models.get("t5xxl"),
+        models["vae"],
+    )
+
+
 def load_models(
     ckpt_path: str,
     clip_l_path: str,
@@ -61,152 +238,156 @@ def load_models(
     device: Union[str, torch.device],
     weight_dtype: torch.dtype,
     disable_mmap: bool = False,
-    t5xxl_device: Optional[str] = None,
-    t5xxl_dtype: Optional[str] = None,
+    t5xxl_device: Optional[Union[str, torch.device]] = None,
+    t5xxl_dtype: Optional[torch.dtype] = None,
+    use_t5xxl: bool = True,
+    max_workers: int = 1,
 ):
+    """
+    Load MMDiT, CLIP-L, CLIP-G, T5XXL and VAE. Each model is built on meta device and its weights are set
+    directly in the target device and dtype, so no model is initialized in fp32 and then cast.
+    If max_workers > 1, separate files are read and models are materialized concurrently on a thread pool.
+    If ckpt_path is a directory saved by save_converted_models, the files are loaded as they are (fast path) and
+    the separate model paths are ignored. t5xxl_dtype then defaults to the exported dtype of t5xxl.
+    Returns (mmdit, clip_l, clip_g, t5xxl, vae). Text encoders not found are None.
+    """
+
     def load_state_dict(path: str, dvc: Union[str, torch.device] = device):
-        if disable_mmap:
-            return safetensors.torch.load(open(path, "rb").read())
-        else:
-            try:
-                return load_file(path, device=dvc)
-            except:
-                return load_file(path)  # prevent device invalid Error
+        return _load_safetensors(path, dvc, disable_mmap)
+
+    def load_text_encoder_state_dict(path: str, dvc: Union[str, torch.device] = device):
+        sd = load_state_dict(path, dvc)
+        for key in list(sd.keys()):
+            sd["transformer." + key] = sd.pop(key)
+        return sd
+
+    def pop_prefixed(state_dict: Dict[str, torch.Tensor], prefix: str):
+        sd = {}
+        for k in list(state_dict.keys()):
+            if k.startswith(prefix):
+                sd[k[len(prefix) :]] = state_dict.pop(k)
+        return sd
 
     t5xxl_device = t5xxl_device or device
 
-    logger.info(f"Loading SD3 models from {ckpt_path}...")
-    state_dict = load_state_dict(ckpt_path)
+    if os.path.isfile(os.path.join(ckpt_path, CONVERTED_MANIFEST_NAME)):
+        logger.info(f"Loading converted SD3 models from {ckpt_path}...")
+        if clip_l_path or clip_g_path or t5xxl_path or vae_path:
+            logger.warning("separate model paths are ignored for converted models")
+        return _load_converted_models(
+            ckpt_path,
+            attn_mode,
+            device,
+            weight_dtype,
+            disable_mmap,
+            t5xxl_device,
+            t5xxl_dtype,
+            use_t5xxl,
+            max_workers,
+        )
 
-    # load clip_l
-    clip_l_sd = None
+    t5xxl_dtype = t5xxl_dtype or weight_dtype
+    load_times: Dict[str, float] = {}
+
+    # read state dicts: the checkpoint and separate files are independent of each other
+    read_tasks = {}
+    logger.info(f"Loading SD3 models from {ckpt_path}...")
+    read_tasks["checkpoint"] = partial(load_state_dict, ckpt_path)
     if clip_l_path:
         logger.info(f"Loading clip_l from {clip_l_path}...")
-        clip_l_sd = load_state_dict(clip_l_path)
-        for key in list(clip_l_sd.keys()):
-            clip_l_sd["transformer." + key] = clip_l_sd.pop(key)
-    else:
-        if (
-            "text_encoders.clip_l.transformer.text_model.embeddings.position_embedding.weight"
-            in state_dict
-        ):
-            # found clip_l: remove prefix "text_encoders.clip_l."
-            logger.info("clip_l is included in the checkpoint")
-            clip_l_sd = {}
-            prefix = "text_encoders.clip_l."
-            for k in list(state_dict.keys()):
-                if k.startswith(prefix):
-                    clip_l_sd[k[len(prefix) :]] = state_dict.pop(k)
-
-    # load clip_g
-    clip_g_sd = None
+        read_tasks["clip_l"] = partial(load_text_encoder_state_dict, clip_l_path)
     if clip_g_path:
         logger.info(f"Loading clip_g from {clip_g_path}...")
-        clip_g_sd = load_state_dict(clip_g_path)
-        for key in list(clip_g_sd.keys()):
-            clip_g_sd["transformer." + key] = clip_g_sd.pop(key)
-    else:
-        if (
-            "text_encoders.clip_g.transformer.text_model.embeddings.position_embedding.weight"
-            in state_dict
-        ):
-            # found clip_g: remove prefix "text_encoders.clip_g."
-            logger.info("clip_g is included in the checkpoint")
-            clip_g_sd = {}
-            prefix = "text_encoders.clip_g."
-            for k in list(state_dict.keys()):
-                if k.startswith(prefix):
-                    clip_g_sd[k[len(prefix) :]] = state_dict.pop(k)
-
-    # load t5xxl
-    t5xxl_sd = None
-    if t5xxl_path:
+        read_tasks["clip_g"] = partial(load_text_encoder_state_dict, clip_g_path)
+    if not use_t5xxl:
+        logger.info("t5xxl is not used")
+    elif t5xxl_path:
         logger.info(f"Loading t5xxl from {t5xxl_path}...")
-        t5xxl_sd = load_state_dict(t5xxl_path, t5xxl_device)
-        for key in list(t5xxl_sd.keys()):
-            t5xxl_sd["transformer." + key] = t5xxl_sd.pop(key)
-    else:
-        if (
-            "text_encoders.t5xxl.transformer.encoder.block.0.layer.0.SelfAttention.k.weight"
-            in state_dict
-        ):
-            # found t5xxl: remove prefix "text_encoders.t5xxl."
-            logger.info("t5xxl is included in the checkpoint")
-            t5xxl_sd = {}
-            prefix = "text_encoders.t5xxl."
-            for k in list(state_dict.keys()):
-                if k.startswith(prefix):
-                    t5xxl_sd[k[len(prefix) :]] = state_dict.pop(k)
-
-    # MMDiT and VAE
-    vae_sd = {}
+        read_tasks["t5xxl"] = partial(
+            load_text_encoder_state_dict, t5xxl_path, t5xxl_device
+        )
     if vae_path:
         logger.info(f"Loading VAE from {vae_path}...")
-        vae_sd = load_state_dict(vae_path)
-    else:
-        # remove prefix "first_stage_model."
-        vae_sd = {}
-        vae_prefix = "first_stage_model."
-        for k in list(state_dict.keys()):
-            if k.startswith(vae_prefix):
-                vae_sd[k[len(vae_prefix) :]] = state_dict.pop(k)
+        read_tasks["vae"] = partial(load_state_dict, vae_path)
+    state_dicts = _run_tasks(read_tasks, max_workers, load_times)
+    state_dict = state_dicts.pop("checkpoint")
 
-    mmdit_prefix = "model.diffusion_model."
-    for k in list(state_dict.keys()):
-        if k.startswith(mmdit_prefix):
-            state_dict[k[len(mmdit_prefix) :]] = state_dict.pop(k)
-        else:
-            state_dict.pop(k)  # remove other keys
+    # load clip_l
+    clip_l_sd = state_dicts.get("clip_l")
+    if (
+        clip_l_sd is None
+        and "text_encoders.clip_l.transformer.text_model.embeddings.position_embedding.weight"
+        in state_dict
+    ):
+        # found clip_l: remove prefix "text_encoders.clip_l."
+        logger.info("clip_l is included in the checkpoint")
+        clip_l_sd = pop_prefixed(state_dict, "text_encoders.clip_l.")
 
-    # load MMDiT
-    logger.info("Building MMDit")
-    with init_empty_weights():
-        mmdit = sd3_models.create_mmdit_sd3_medium_configs(attn_mode)
+    # load clip_g
+    clip_g_sd = state_dicts.get("clip_g")
+    if (
+        clip_g_sd is None
+        and "text_encoders.clip_g.transformer.text_model.embeddings.position_embedding.weight"
+        in state_dict
+    ):
+        # found clip_g: remove prefix "text_encoders.clip_g."
+        logger.info("clip_g is included in the checkpoint")
+        clip_g_sd = pop_prefixed(state_dict, "text_encoders.clip_g.")
 
-    logger.info("Loading state dict...")
-    info = _load_state_dict_on_device(mmdit, state_dict, device, weight_dtype)
-    logger.info(f"Loaded MMDiT: {info}")
+    # load t5xxl
+    t5xxl_sd = state_dicts.get("t5xxl")
+    if (
+        use_t5xxl
+        and t5xxl_sd is None
+        and "text_encoders.t5xxl.transformer.encoder.block.0.layer.0.SelfAttention.k.weight"
+        in state_dict
+    ):
+        # found t5xxl: remove prefix "text_encoders.t5xxl."
+        logger.info("t5xxl is included in the checkpoint")
+        t5xxl_sd = pop_prefixed(state_dict, "text_encoders.t5xxl.")
 
-    # load ClipG and ClipL
-    if clip_l_sd is None:
-        clip_l = None
-    else:
-        logger.info("Building ClipL")
-        clip_l = sd3_models.create_clip_l(device, weight_dtype, clip_l_sd)
-        logger.info("Loading state dict...")
-        info = clip_l.load_state_dict(clip_l_sd)
-        logger.info(f"Loaded ClipL: {info}")
-        clip_l.set_attn_mode(attn_mode)
-
-    if clip_g_sd is None:
-        clip_g = None
-    else:
-        logger.info("Building ClipG")
-        clip_g = sd3_models.create_clip_g(device, weight_dtype, clip_g_sd)
-        logger.info("Loading state dict...")
-        info = clip_g.load_state_dict(clip_g_sd)
-        logger.info(f"Loaded ClipG: {info}")
-        clip_g.set_attn_mode(attn_mode)
-
-    # load T5XXL
-    if t5xxl_sd is None:
-        t5xxl = None
-    else:
-        logger.info("Building T5XXL")
-        t5xxl = sd3_models.create_t5xxl(t5xxl_sd, t5xxl_device, t5xxl_dtype)
-        logger.info("Loading state dict...")
-        info = t5xxl.load_state_dict(t5xxl_sd)
-        logger.info(f"Loaded T5XXL: {info}")
-        t5xxl.set_attn_mode(attn_mode)
+    # MMDiT and VAE
+    vae_sd = state_dicts.get("vae")
+    if vae_sd is None:
+        # remove prefix "first_stage_model."
+        vae_sd = pop_prefixed(state_dict, "first_stage_model.")
 
-    # load VAE
-    logger.info("Building VAE")
-    vae = sd3_models.SDVAE()
-    logger.info("Loading state dict...")
-    info = vae.load_state_dict(vae_sd)
-    logger.info(f"Loaded VAE: {info}")
+    # remaining keys are MMDiT or unused text encoders (eg. t5xxl with use_t5xxl=False)
+    state_dict = pop_prefixed(state_dict, "model.diffusion_model.")
 
-    return mmdit, clip_l, clip_g, t5xxl, vae
+    build_tasks = {
+        "mmdit": partial(
+            _build_model, "mmdit", state_dict, attn_mode, device, weight_dtype
+        )
+    }
+    if clip_l_sd is not None:
+        build_tasks["clip_l"] = partial(
+            _build_model, "clip_l", clip_l_sd, attn_mode, device, weight_dtype
+        )
+    if clip_g_sd is not None:
+        build_tasks["clip_g"] = partial(
+            _build_model, "clip_g", clip_g_sd, attn_mode, device, weight_dtype
+        )
+    if t5xxl_sd is not None:
+        build_tasks["t5xxl"] = partial(
+            _build_model, "t5xxl", t5xxl_sd, attn_mode, t5xxl_device, t5xxl_dtype
+        )
+    build_tasks["vae"] = partial(
+        _build_model, "vae", vae_sd, attn_mode, device, weight_dtype
+    )
+    models = _run_tasks(build_tasks, max_workers, load_times)
+
+    logger.info(
+        "Load times: "
+        + ", ".join(f"{name}: {sec:.2f}s" for name, sec in load_times.items())
+    )
+    return (
+        models["mmdit"],
+        models.get("clip_l"),
+        models.get("clip_g"),
+        models.get("t5xxl"),
+        models["vae"],
+    )
 
 
 # endregion
@@ -246,6 +427,8 @@ def get_cond_from_tokens(
         t5_out, _ = t5xxl.encode_token_weights(
             t5_tokens
         )  # t5_out is [1, 77, 4096], t5_pooled is None
+        # on the device and dtype of the CLIP outputs, to be concatenated with them
+        t5_out = t5_out.to(lg_out.device, lg_out.dtype)
 
     # return torch.cat([lg_out, t5_out], dim=-2), torch.cat((l_pooled, g_pooled), dim=-1)
     return lg_out, t5_out, torch.cat((l_pooled, g_pooled), dim=-1)
@@ -302,6 +485,31 @@ def create_mmdit_from_sd3_checkpoint(state_dict: Dict, attn_mode: str = "xformer
 """
 
 
+SIGMA_SPACINGS = ["timestep", "sigma", "karras"]
+
+
+@lru_cache(maxsize=64)
+def _get_sigma_schedule(steps: int, shift: float, spacing: str) -> torch.Tensor:
+    model_sampling = ModelSamplingDiscreteFlow(shift)
+    sigma_max = model_sampling.sigma_max
+    sigma_min = model_sampling.sigma_min
+    if spacing == "timestep":
+        start = model_sampling.timestep(sigma_max)
+        end = model_sampling.timestep(sigma_min)
+        sigmas = model_sampling.sigma(torch.linspace(start, end, steps))
+    elif spacing == "sigma":
+        sigmas = torch.linspace(sigma_max, sigma_min, steps)
+    elif spacing == "karras":
+        rho = 7.0
+        ramp = torch.linspace(0, 1, steps)
+        max_inv_rho = sigma_max ** (1 / rho)
+        min_inv_rho = sigma_min ** (1 / rho)
+        sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+    else:
+        raise ValueError(f"unknown sigma spacing: {spacing}")
+    return torch.cat([sigmas.float(), sigmas.new_zeros(1, dtype=torch.float32)])
+
+
 class ModelSamplingDiscreteFlow:
     """Helper for sampler scheduling (ie timestep/sigma calculations) for Discrete Flow models"""
 
@@ -334,16 +542,15 @@ class ModelSamplingDiscreteFlow:
     def noise_scaling(self, sigma, noise, latent_image, max_denoise=False):
         return sigma * noise + (1.0 - sigma) * latent_image
 
-    def get_sigmas(self, steps: int):
-        start = self.timestep(self.sigma_max)
-        end = self.timestep(self.sigma_min)
-        timesteps = torch.linspace(start, end, steps)
-        sigs = []
-        for x in range(len(timesteps)):
-            ts = timesteps[x]
-            sigs.append(self.sigma(ts))
-        sigs += [0.0]
-        return torch.FloatTensor(sigs)
+    def get_sigmas(self, steps: int, spacing: str = "timestep"):
+        """
+        Returns steps + 1 sigmas from sigma_max to 0. spacing is one of SIGMA_SPACINGS:
+        timestep: uniform in timestep, then shifted (SD3 reference schedule)
+        sigma: uniform in shifted sigma
+        karras: Karras et al. 2022 schedule with rho = 7, dense near sigma_min
+        Schedules are cached per (steps, shift, spacing), a copy is returned.
+        """
+        return _get_sigma_schedule(steps, float(self.shift), spacing).clone()
 
     def max_denoise(self, sigmas: torch.FloatTensor):
         max_sigma = float(self.sigma_max)
@@ -0,0 +1,145 @@
+import functools
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from networks.stable_diffusion3 import sd3_models, sd3_utils
+from networks.stable_diffusion3.sd3_test_utils import create_tiny_mmdit
+
+
+@pytest.mark.parametrize("shift", [1.0, 3.0])
+def test_get_sigmas_matches_timestep_schedule(shift):
+    model_sampling = sd3_utils.ModelSamplingDiscreteFlow(shift)
+    timesteps = torch.linspace(
+        model_sampling.timestep(model_sampling.sigma_max),
+        model_sampling.timestep(model_sampling.sigma_min),
+        28,
+    )
+    expected = torch.FloatTensor([model_sampling.sigma(t) for t in timesteps] + [0.0])
+    assert torch.equal(model_sampling.get_sigmas(28), expected)
+
+
+@pytest.mark.parametrize("spacing", sd3_utils.SIGMA_SPACINGS)
+def test_get_sigmas_spacing(spacing):
+    model_sampling = sd3_utils.ModelSamplingDiscreteFlow(3.0)
+    sigmas = model_sampling.get_sigmas(10, spacing)
+    assert sigmas.shape == (11,)
+    assert sigmas[0] == 1.0 and sigmas[-1] == 0.0
+    assert torch.all(sigmas[1:] < sigmas[:-1])
+
+    # cached, but the caller gets its own copy
+    sigmas[0] = 2.0
+    assert model_sampling.get_sigmas(10, spacing)[0] == 1.0
+
+
+def create_tiny_t5xxl(state_dict=None, device="cpu", dtype=torch.float32):
+    config = {
+        "d_ff": 64,
+        "d_model": 32,
+        "num_heads": 2,
+        "num_layers": 1,
+        "vocab_size": 100,
+    }
+    with torch.no_grad():
+        return sd3_models.T5XXLModel(config, dtype=dtype, device=device)
+
+
+@pytest.fixture
+def tiny_models(monkeypatch):
+    # load_models builds the SD3 medium MMDiT, the full T5XXL and VAE, make them tiny
+    monkeypatch.setattr(
+        sd3_models,
+        "create_mmdit_sd3_medium_configs",
+        lambda attn_mode: create_tiny_mmdit(),
+    )
+    monkeypatch.setattr(sd3_models, "create_t5xxl", create_tiny_t5xxl)
+    for name in ("VAEEncoder", "VAEDecoder"):
+        cls = getattr(sd3_models, name)
+        monkeypatch.setattr(
+            sd3_models,
+            name,
+            functools.partial(cls, ch=32, ch_mult=(1, 2, 2), num_res_blocks=1),
+        )
+    mmdit = create_tiny_mmdit().to(torch.bfloat16)
+    # T5XXL in another dtype than the other models
+    t5xxl = create_tiny_t5xxl(dtype=torch.float16)
+    vae = sd3_models.SDVAE(dtype=torch.bfloat16)
+    for model in (t5xxl, vae):
+        for tensor in model.state_dict().values():
+            tensor.normal_(0, 0.02)
+    return mmdit, t5xxl, vae
+
+
+def assert_same_state_dict(model, expected):
+    state_dict, expected = model.state_dict(), expected.state_dict()
+    assert state_dict.keys() == expected.keys()
+    for key, tensor in expected.items():
+        assert state_dict[key].dtype == tensor.dtype, key
+        assert torch.equal(state_dict[key], tensor), key
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_load_models_export_round_trip(tmp_path, tiny_models, max_workers):
+    mmdit, t5xxl, vae = tiny_models
+    # an SD3 checkpoint with T5XXL and without the CLIP models
+    checkpoint = {
+        f"model.diffusion_model.{k}": v for k, v in mmdit.state_dict().items()
+    }
+    checkpoint.update(
+        {f"text_encoders.t5xxl.{k}": v for k, v in t5xxl.state_dict().items()}
+    )
+    checkpoint.update(
+        {f"first_stage_model.{k}": v for k, v in vae.state_dict().items()}
+    )
+    ckpt_path = str(tmp_path / "sd3.safetensors")
+    save_file(checkpoint, ckpt_path)
+
+    def load(path, weight_dtype=torch.bfloat16, t5xxl_dtype=None):
+        return sd3_utils.load_models(
+            path,
+            None,
+            None,
+            None,
+            None,
+            "torch",
+            "cpu",
+            weight_dtype,
+            t5xxl_dtype=t5xxl_dtype,
+            max_workers=max_workers,
+        )
+
+    loaded = load(ckpt_path, t5xxl_dtype=torch.float16)
+    loaded_mmdit, clip_l, clip_g, loaded_t5xxl, loaded_vae = loaded
+    assert clip_l is None and clip_g is None
+    assert_same_state_dict(loaded_mmdit, mmdit)
+    assert_same_state_dict(loaded_t5xxl, t5xxl)
+    assert_same_state_dict(loaded_vae, vae)
+
+    # exported files are loaded as they are, T5XXL in its exported dtype
+    export_dir = str(tmp_path / "converted")
+    sd3_utils.save_converted_models(
+        export_dir,
+        mmdit=loaded_mmdit,
+        clip_l=None,
+        clip_g=None,
+        t5xxl=loaded_t5xxl,
+        vae=loaded_vae,
+    )
+    converted = load(export_dir)
+    converted_mmdit, clip_l, clip_g, converted_t5xxl, converted_vae = converted
+    assert clip_l is None and clip_g is None
+    assert_same_state_dict(converted_mmdit, mmdit)
+    assert_same_state_dict(converted_t5xxl, t5xxl)
+    assert_same_state_dict(converted_vae, vae)
+
+    # or cast when another dtype is requested
+    converted_mmdit, _, _, converted_t5xxl, _ = load(
+        export_dir, torch.float32, torch.float32
+    )
+    assert_same_state_dict(converted_mmdit, mmdit.float())
+    assert_same_state_dict(converted_t5xxl, t5xxl.float())
+
+
+if __name__ == "__main__":
+    pytest.main()